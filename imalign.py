@@ -4,16 +4,32 @@ from __future__ import print_function
 
 import sys
 import argparse
-import ast
+import bisect
+import collections
+import math
 import os
+import threading
+
+import numpy as np
 
 import Tkinter as tk
 import tkMessageBox
 from PIL import Image, ImageTk
 
-from multiprocessing import Process, Pipe
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 import datetime
+import Queue
+
+from imio import write_anchors, AnchorJournal
+from imio import anchors_from_lists
+from imoptim import OnlineSolver
+from imcache import ThumbCache, ImageLRU, MetadataIndex, read_image_info
+from imcache import get_default_cache_dir, get_pyramid_levels, prune_pyramids
+from imcache import PYRAMID_TILE
+from imloader import LoaderPool, MAIN, VISIBLE, BACKGROUND
+from imkeypoints import suggest_anchors
 
 def parse_command_line():
   parser = argparse.ArgumentParser(
@@ -23,48 +39,55 @@ def parse_command_line():
                       help="a file in the image set.")
   parser.add_argument('-o', '--output', default='img_anchors.txt',
                       help="where to store anchor positions")
+  parser.add_argument('--cache-dir', default=get_default_cache_dir(),
+                      help="folder for the persistent thumbnail cache")
+  parser.add_argument('--cache-size', type=int, default=512,
+                      help="maximum size of the thumbnail cache, in MB")
+  parser.add_argument('--image-cache-size', type=int, default=256,
+                      help="memory used for keeping recently viewed images, "
+                      "in MB")
+  parser.add_argument('--pyramid-cache-size', type=int, default=4096,
+                      help="maximum size of the cached zoom pyramids, in MB")
+  parser.add_argument('-j', '--workers', type=int, default=cpu_count(),
+                      help="number of processes used for loading images")
+  parser.add_argument('--suggest', type=int, default=0,
+                      help="number of candidate anchors to suggest from "
+                      "keypoints matched across the images (0 for none)")
 
   args = parser.parse_args()
 
   return args
 
-def load_thumbs(files, thumb_pos, pipe_end):
-  for i, f in enumerate(files):
-    pos = thumb_pos[i]
-
-    img0 = Image.open(f)
-    img0.draft(img0.mode, pos[2:])
-    img = img0.resize(pos[2:], resample=Image.LANCZOS)
-
-    msg = {
-      'i':      i,
-      'pixels': img.tobytes(),
-      'size':   img.size,
-      'mode':   img.mode
-    }
-    pipe_end.send(msg)
-
-def load_image(f, i, image_pos, pipe_end):
-  img0 = Image.open(f)
-  im_w = image_pos[2] - image_pos[0]
-  im_h = image_pos[3] - image_pos[1]
-  img0.draft(img0.mode, (im_w, im_h))
-  img = img0.resize((im_w, im_h), resample=Image.LANCZOS)
-
-  msg = {
-    'i':      i,
-    'pos':    image_pos,
-    'pixels': img.tobytes(),
-    'size':   img.size,
-    'mode':   img.mode
-  }
-  pipe_end.send(msg)
+def get_image_info(i, fname, cached):
+  # runs on a worker thread; errors are passed back instead of raised
+  try:
+    return (i, read_image_info(fname, cached), None)
+  except Exception as e:
+    return (i, None, "{}: {}".format(type(e).__name__, e))
+
+def get_day(date_str):
+  # for calculating time differences, set all datetimes to midnight
+  # but set any time before 6am as referring to previous day
+  if date_str is None:
+    return None
+  try:
+    date0 = datetime.datetime.strptime(date_str, '%Y:%m:%d %H:%M:%S')
+  except ValueError:
+    return None
+  date = date0.replace(hour=0, minute=0, second=0)
+  if date0.hour < 6:
+    date = date - datetime.timedelta(days=1)
+  return date
 
 class Tag(tk.Frame):
   def __init__(self, variable=None, value=None, master=None, text="anchor",
-               close_btn=True, before_close=None):
+               close_btn=True, before_close=None, on_rename=None):
     tk.Frame.__init__(self, master=master)
 
+    # name as of the last time editing finished
+    self.name = text
+    self.on_rename = on_rename
+
     self.radio = tk.Radiobutton(master=self, variable=variable, value=value)
     self.radio.pack(side=tk.LEFT)
 
@@ -77,6 +100,7 @@ class Tag(tk.Frame):
         self.focus_set()
 
     self.tag.bind("<Key>", key_callback)
+    self.tag.bind("<FocusOut>", lambda event: self.commit_name())
 
     if close_btn:
       self.close_btn = tk.Button(master=self, text=u"×", 
@@ -85,6 +109,13 @@ class Tag(tk.Frame):
     else:
       self.close_btn = None
 
+  def commit_name(self):
+    name = self.tag.get()
+    if name != self.name:
+      self.name = name
+      if self.on_rename is not None:
+        self.on_rename(self)
+
   def close_fct(self, before_close=None):
     if before_close is not None:
       b = before_close(self)
@@ -98,10 +129,14 @@ class TagFrame(tk.Frame):
     self.n_files = kwargs.pop('n_files')
     self.add_callback = kwargs.pop('add_callback', None)
     self.del_callback = kwargs.pop('del_callback', None)
+    self.set_callback = kwargs.pop('set_callback', None)
     self.out_file = kwargs.pop('out_file', None)
 
     tk.Frame.__init__(self, *args, **kwargs)
 
+    # every change is recorded here once set
+    self.journal = None
+
     self.radio_variable = tk.IntVar(value=0)
     self.tags = []
 #    self.tags = [Tag(master=self, variable=self.radio_variable,
@@ -122,28 +157,40 @@ class TagFrame(tk.Frame):
 
     self.next_i = 1
 
-  def save_tags(self):
+  def get_state(self):
+    # anchor names and per-image lists of anchors
+    for tag in self.tags:
+      tag.commit_name()
+    anchor_names = [tag.name for tag in self.tags]
+    return (anchor_names, [[anchor_list[k] for anchor_list in self.anchors]
+                           for k in xrange(self.n_files)])
+
+  def save_tags(self, wait=False):
     if self.out_file == None:
       return
 
-    with open(self.out_file, 'wt') as f:
-      for i, tag in enumerate(self.tags):
-        if i > 0:
-          f.write("\t")
-        f.write(tag.tag.get())
-
-      f.write("\n")
+    # with a journal, everything is already on disk; this only compacts it
+    # into the anchors file
+    if self.journal is not None:
+      if self.journal.compact(*self.get_state(), wait=wait):
+        print("Saving anchors to {}.".format(self.out_file))
+      return
 
-      for k in xrange(self.n_files):
-        for i, anchor_list in enumerate(self.anchors):
-          if i > 0:
-            f.write("\t")
-          f.write(str(anchor_list[k]))
+    write_anchors(self.out_file, *self.get_state())
 
-        f.write("\n")
-      
     print("Saved anchors to {}.".format(self.out_file))
 
+  def record(self, **record):
+    if self.journal is not None:
+      self.journal.record(**record)
+      if self.journal.needs_compaction():
+        self.save_tags()
+
+  def rename_tag(self, tag):
+    for i, tag1 in enumerate(self.tags):
+      if tag1 is tag:
+        self.record(op='rename', k=i, name=tag.name)
+
   def add_tag(self, text=None):
 #    value = len(self.tags) + 1
     value = self.next_i
@@ -168,6 +215,7 @@ class TagFrame(tk.Frame):
 
         self.tags.pop(i0)
         self.anchors.pop(i0)
+        self.record(op='remove', k=i0)
 
         if self.radio_variable.get() == value0:
           i = min(i0, len(self.tags)-1)
@@ -178,12 +226,13 @@ class TagFrame(tk.Frame):
 
     self.tags.append(Tag(master=self, variable=self.radio_variable,
                          value=value, text=text, before_close=cleanup,
-                         close_btn=(value > 1)))
+                         close_btn=(value > 1), on_rename=self.rename_tag))
     self.tags[-1].pack(side=tk.TOP, anchor=tk.W,
         pady=(32, 0) if value == 1 else 0)
 
     self.anchors.append([None for _ in xrange(self.n_files)])
     self.next_i += 1
+    self.record(op='add', name=text)
 
     if value == 1:
       self.radio_variable.set(1)
@@ -218,17 +267,41 @@ class TagFrame(tk.Frame):
   def update_some_anchor(self, file_idx, anchor_idx, data):
     if anchor_idx is not None:
       self.anchors[anchor_idx][file_idx] = data
+      self.record(op='set', i=file_idx, k=anchor_idx, pos=data)
+      if self.set_callback is not None:
+        self.set_callback(file_idx, anchor_idx, data)
 
 class Anchorer(object):
-  def __init__(self, files, out_file=None):
+  def __init__(self, files, out_file=None, cache_dir=None,
+               cache_size=512*1024*1024, image_cache_size=256*1024*1024,
+               n_workers=None, pyramid_cache_size=4096*1024*1024,
+               n_suggestions=0):
     # sort the files before displaying
     self.files = list(files)
     self.files.sort()
 
     self.out_file = out_file
-
-    self.thumb_handles = [None for _ in self.files]
-    self.rect_handles = [None for _ in self.files]
+    self.journal = None
+    if cache_dir is None:
+      cache_dir = get_default_cache_dir()
+    self.thumb_cache = ThumbCache(cache_dir, max_bytes=cache_size)
+
+    # tile pyramids for zooming are built by the loader processes the first
+    # time an image is zoomed into, and kept across sessions; the cache is
+    # pruned after every new one
+    self.pyramid_dir = os.path.join(cache_dir, 'pyramids')
+    self.pyramid_cache_size = pyramid_cache_size
+    prune_pyramids(self.pyramid_dir, pyramid_cache_size)
+
+    # image sizes and dates come from the index at first, and are checked
+    # against the files by a thread pool once the window is up; images that
+    # are not in the index get `default_size` until then
+    self.metadata = MetadataIndex(cache_dir)
+    self.metadata_queue = Queue.Queue()
+    self.metadata_pool = None
+    self.n_metadata_threads = 16
+    self.n_metadata_pending = 0
+    self.default_size = (3000, 2000)
 
     self.root_width = 1200
     self.root_height = 700
@@ -239,23 +312,74 @@ class Anchorer(object):
     self.thumb_title_size = 10
 
     self.thumb_spacing = 16
-    self.thumb_loader = None
 
-    self.check_thumb_alarm = None
-    self.thumb_pipe = None
+    # only the thumbnails in view, plus `thumb_margin` on each side, get
+    # canvas items; these are recycled while scrolling. Loaded thumbnails are
+    # kept in a bounded LRU.
+    self.thumb_margin = 20
+    self.thumb_items = {}
+    self.free_thumb_items = []
+    self.thumb_photos = collections.OrderedDict()
+    self.max_thumb_photos = 300
+    self.thumb_range = None
+    self.thumbs_requested = set()
+    self.strip_update_pending = False
+
+    # all images are loaded by one pool of worker processes
+    self.n_workers = n_workers
+    self.loader = None
+    self.pipe_watchers = {}
+    self.poll_interval = 20
 
     self.main_rectangle = None
     self.main_image_handle = None
+    self.main_image_item = None
     self.main_rect_handle = None
     self.main_spacing = 8
     self.selected_i = -1
-    self.main_loader = None
-    self.check_image_alarm = None
     self.anchor_size = 5
+    self.main_image = None
+    self.backdrop_handle = None
+
+    # the main canvas either fits the whole image (view_scale is None), or
+    # shows it with `view_scale` canvas pixels per image pixel and its corner
+    # at `view_origin`, assembled from pyramid tiles
+    self.view_scale = None
+    self.view_origin = (0.0, 0.0)
+    self.max_view_scale = 16.0
+    self.zoom_step = 1.25
+    self.tile_items = {}
+    # tiles are kept up to a total number of pixel bytes, as in ImageLRU
+    self.tile_photos = collections.OrderedDict()
+    self.tile_bytes = 0
+    self.max_tile_bytes = 128*1024*1024
+    self.view_update_pending = False
+    self.pan_start = None
+
+    # recently viewed images at display resolution, plus the neighbors of the
+    # selected image, loaded ahead of time
+    self.image_cache = ImageLRU(image_cache_size)
+    self.prefetch_range = 2
+
+    # transformation estimates, kept up to date with every click, for
+    # showing residuals and where the selected anchor is expected
+    self.solver = OnlineSolver(len(self.files))
 
     self.canvas_anchors = None
     self.anchor_colors = ['black', '#a00', '#00d', '#080', '#d80']
 
+    # candidate anchors from keypoints matched across the images, found in
+    # the background; the first one is shown until it is accepted or
+    # rejected
+    self.n_suggestions = n_suggestions
+    self.keypoint_dir = os.path.join(cache_dir, 'keypoints')
+    self.suggestions = []
+    self.suggestion_queue = Queue.Queue()
+    self.keypoints = []
+    self.n_keypoints_pending = 0
+    self.suggestion_exclude = None
+    self.n_accepted = 0
+
     self.load_image_data_()
 
   def init_anchors(self, anchor_names, anchors):
@@ -263,172 +387,678 @@ class Anchorer(object):
       for name in anchor_names:
         self.tag_frame.add_tag(name)
 
+      # filled in directly, without a solver update per anchor; the solver
+      # is then rebuilt once
       for i, anchors_per_img in enumerate(anchors):
         for j, anchor in enumerate(anchors_per_img):
-          self.tag_frame.update_some_anchor(i, j, anchor)
+          self.tag_frame.anchors[j][i] = anchor
+      self.reset_solver_()
     else:
       self.tag_frame.add_tag("anchor #1")
 
+  def load_anchors(self):
+    # rebuild the anchors from the anchors file and its journal, then record
+    # all further changes in the journal
+    if self.out_file is None:
+      self.init_anchors(None, None)
+      return
+
+    self.journal = AnchorJournal(self.out_file)
+    anchor_names, anchors, replayed = self.journal.load(len(self.files))
+    if len(anchor_names) > 0:
+      self.init_anchors(anchor_names, anchors)
+
+    # if anything was replayed, also bring the anchors file up to date
+    if replayed:
+      print("Recovered unsaved anchors from the journal.")
+      self.journal.compact(anchor_names, anchors)
+    else:
+      self.journal.begin(anchor_names, anchors)
+    self.tag_frame.journal = self.journal
+
+    if len(anchor_names) == 0:
+      self.init_anchors(None, None)
+
   def load_image_data_(self):
-    sys.stdout.write("Loading image sizes and dates... ")
-    sys.stdout.flush()
-    self.img_sizes = []
-    self.img_dates = []
-    for file in self.files:
-      im = Image.open(file)
-      self.img_sizes.append(im.size)
-      date0 = datetime.datetime.strptime(im._getexif()[36867],
-                                         '%Y:%m:%d %H:%M:%S')
-      # for calculating time differences, set all datetimes to midnight
-      # but set any time before 6am as referring to previous day
-      date = date0.replace(hour=0, minute=0, second=0)
-      if date0.hour < 6:
-        date = date - datetime.timedelta(days=1)
-      self.img_dates.append(date)
-    sys.stdout.write("done.\n")
-    sys.stdout.flush()
-
-  def draw_placeholders_(self):
+    entries = self.metadata.get(self.files)
+    self.img_info = [entries.get(_) for _ in self.files]
+    self.img_sizes = [(_['width'], _['height']) if _ is not None
+                      else self.default_size for _ in self.img_info]
+    self.img_dates = [get_day(_['date']) if _ is not None else None
+                      for _ in self.img_info]
+    print("Found {} of {} images in the metadata index.".format(
+        len(entries), len(self.files)))
+
+  def refresh_image_data_(self):
+    self.metadata_pool = ThreadPool(self.n_metadata_threads)
+    self.n_metadata_pending = len(self.files)
+    for i, f in enumerate(self.files):
+      self.metadata_pool.apply_async(get_image_info,
+          (i, f, self.img_info[i]), callback=self.metadata_queue.put)
+    self.root.after(self.poll_interval, self.check_image_data_)
+
+  def check_image_data_(self):
+    # apply whatever the threads found since the last check, all at once
+    changed = []
+    resized = False
+    updated = []
+    while True:
+      try:
+        i, info, error = self.metadata_queue.get_nowait()
+      except Queue.Empty:
+        break
+      self.n_metadata_pending -= 1
+
+      if error is not None:
+        print("Failed to read {}: {}".format(self.files[i], error),
+              file=sys.stderr)
+        continue
+      if info is self.img_info[i]:
+        continue
+
+      updated.append(info)
+      self.img_info[i] = info
+      size = (info['width'], info['height'])
+      if size != self.img_sizes[i]:
+        self.img_sizes[i] = size
+        self.thumb_photos.pop(i, None)
+        resized = True
+      self.img_dates[i] = get_day(info['date'])
+      changed.append(i)
+
+    self.metadata.put(updated)
+    if len(changed) > 0:
+      if resized:
+        self.layout_thumbs_()
+        self.thumbnails.config(scrollregion=(0, 0, self.thumb_strip_width,
+                                             self.thumb_slider_height))
+      # titles are relative to the first image, so redo all the visible ones
+      for i in list(self.thumb_items):
+        self.release_thumb_(i)
+      self.thumb_range = None
+      self.update_thumb_strip_()
+
+      if self.selected_i in changed:
+        self.update_main_rectangle_(self.selected_i, force=True)
+
+    if self.n_metadata_pending > 0:
+      self.root.after(self.poll_interval, self.check_image_data_)
+    else:
+      self.metadata_pool.close()
+      self.metadata_pool = None
+      print("Finished reading image metadata.")
+
+  def layout_thumbs_(self):
+    # thumbnail positions only; canvas items are made on demand
     x = self.thumb_spacing
     y_title = self.thumb_spacing
     y = int(y_title + 1.5*self.thumb_title_size)
+    self.thumb_title_y = y_title
     self.thumb_pos = []
-    for i, size in enumerate(self.img_sizes):
+    self.thumb_x = []
+    for size in self.img_sizes:
       thumb_height = self.thumb_height
       thumb_width = int(float(size[0])*thumb_height/size[1])
       if thumb_width > self.max_thumb_width:
         thumb_width = self.max_thumb_width
         thumb_height = int(float(size[1])*thumb_width/size[0])
 
-      if self.rect_handles[i] is not None:
-        self.thumbnails.delete(self.rect_handles[i])
-      self.rect_handles[i] = self.thumbnails.create_rectangle(
-          (x-1, y-1, x+thumb_width, y+thumb_height))
       self.thumb_pos.append((x, y, thumb_width, thumb_height))
+      self.thumb_x.append(x)
 
-      # create title
-      day = (self.img_dates[i] - self.img_dates[0]).days + 1
-      title = "{}. Day {}".format(i+1, day)
-      self.thumbnails.create_text((x + thumb_width/2, y_title),
-                                  text=title,
-                                  font=('Helvetica', self.thumb_title_size),
-                                  anchor=tk.N)
-      
       x = x + thumb_width + self.thumb_spacing
 
+    self.thumb_strip_width = x
+
+  def get_title_(self, i):
+    if self.img_dates[i] is None or self.img_dates[0] is None:
+      return "{}. Day ?".format(i+1)
+    day = (self.img_dates[i] - self.img_dates[0]).days + 1
+    return "{}. Day {}".format(i+1, day)
+
+  def get_visible_thumbs_(self):
+    # range of thumbnails that are at least partly in view
+    x0, x1 = self.thumbnails.xview()
+    left = x0*self.thumb_strip_width
+    right = x1*self.thumb_strip_width
+    first = max(bisect.bisect_right(self.thumb_x, left) - 1, 0)
+    last = bisect.bisect_left(self.thumb_x, right)
+    return (first, last)
+
+  def place_thumb_(self, i):
+    # give thumbnail `i` a set of canvas items, reusing old ones if possible
+    if len(self.free_thumb_items) > 0:
+      items = self.free_thumb_items.pop()
+    else:
+      items = (self.thumbnails.create_rectangle((0, 0, 0, 0)),
+               self.thumbnails.create_text((0, 0),
+                   font=('Helvetica', self.thumb_title_size), anchor=tk.N),
+               self.thumbnails.create_image(0, 0, anchor=tk.NW))
+    self.thumb_items[i] = items
+
+    x, y, thumb_width, thumb_height = self.thumb_pos[i]
+    rect, text, image = items
+    self.thumbnails.coords(rect, (x-1, y-1, x+thumb_width, y+thumb_height))
+    self.thumbnails.coords(text, (x + thumb_width/2, self.thumb_title_y))
+    self.thumbnails.itemconfig(text, text=self.get_title_(i))
+    self.thumbnails.coords(image, (x, y))
+    for item in items:
+      self.thumbnails.itemconfig(item, state=tk.NORMAL)
+
+    photo = self.thumb_photos.get(i)
+    if photo is None:
+      img = self.thumb_cache.get(self.files[i], self.thumb_pos[i][2:])
+      if img is not None:
+        self.show_thumb_(i, img)
+    else:
+      self.thumb_photos[i] = self.thumb_photos.pop(i)
+      self.thumbnails.itemconfig(image, image=photo)
+
+  def release_thumb_(self, i):
+    items = self.thumb_items.pop(i)
+    self.thumbnails.itemconfig(items[2], image='')
+    for item in items:
+      self.thumbnails.itemconfig(item, state=tk.HIDDEN)
+    self.free_thumb_items.append(items)
+
+  def request_thumbs_(self, first, last, lo, hi):
+    # load the thumbnails in view from left to right, then the ones in the
+    # margins, closest first; anything requested for an earlier view is
+    # dropped
+    self.loader.cancel(VISIBLE)
+    self.loader.cancel(BACKGROUND, kind='thumb')
+    self.thumbs_requested = set()
+
+    order = [(VISIBLE, _) for _ in range(first, last)]
+    for k in range(max(first - lo, hi - last)):
+      for i in (last + k, first - 1 - k):
+        if i >= lo and i < hi:
+          order.append((BACKGROUND, i))
+
+    for level, i in order:
+      if i not in self.thumb_photos:
+        self.loader.submit(level, 'thumb', i, self.thumb_pos[i][2:], rank=1)
+        self.thumbs_requested.add(i)
+
+  def update_thumb_strip_(self):
+    self.strip_update_pending = False
+    first, last = self.get_visible_thumbs_()
+    lo = max(first - self.thumb_margin, 0)
+    hi = min(last + self.thumb_margin, len(self.files))
+
+    for i in [_ for _ in self.thumb_items if _ < lo or _ >= hi]:
+      self.release_thumb_(i)
+    for i in range(lo, hi):
+      if i not in self.thumb_items:
+        self.place_thumb_(i)
+
+    if self.thumb_range != (first, last):
+      self.thumb_range = (first, last)
+      self.request_thumbs_(first, last, lo, hi)
+
+    # forget the least recently used thumbnails that are out of range
+    excess = len(self.thumb_photos) - self.max_thumb_photos
+    if excess > 0:
+      for i in [_ for _ in self.thumb_photos
+                if _ not in self.thumb_items][:excess]:
+        del self.thumb_photos[i]
+
+  def thumb_scroll_callback_(self, first, last):
+    self.xscrollbar.set(first, last)
+    # coalesce the many scroll events of a drag into one update
+    if not self.strip_update_pending:
+      self.strip_update_pending = True
+      self.root.after_idle(self.update_thumb_strip_)
+
+  def find_suggestions_(self, exclude):
+    # runs on a background thread, once the loader processes have found the
+    # keypoints of every image
+    try:
+      reference = self.solver.reference
+      if self.keypoints[reference] is None:
+        candidates = np.zeros((len(self.files), 0, 2))
+      else:
+        candidates = suggest_anchors(self.keypoints, reference=reference,
+                                     count=self.n_suggestions,
+                                     exclude=exclude)
+      self.suggestion_queue.put((candidates, None))
+    except Exception as e:
+      self.suggestion_queue.put((None, "{}: {}".format(type(e).__name__, e)))
+
+  def start_suggestions_(self):
+    # keypoints are found by the loader processes, after everything else in
+    # the background; existing anchors are not suggested again
+    reference = self.solver.reference
+    self.suggestion_exclude = [anchor_list[reference]
+                               for anchor_list in self.tag_frame.anchors
+                               if anchor_list[reference] is not None]
+    self.keypoints = [None for _ in self.files]
+    self.n_keypoints_pending = len(self.files)
+    for i in xrange(len(self.files)):
+      self.loader.submit(BACKGROUND, 'keypoints', i, (0, 0),
+                         data=self.keypoint_dir, rank=1)
+    print("Looking for candidate anchors.")
+
+  def keypoints_done_(self, i, keypoints):
+    self.keypoints[i] = keypoints
+    self.n_keypoints_pending -= 1
+    if self.n_keypoints_pending > 0:
+      return
+
+    thread = threading.Thread(target=self.find_suggestions_,
+                              args=(self.suggestion_exclude, ))
+    thread.daemon = True
+    thread.start()
+    self.root.after(self.poll_interval, self.check_suggestions_)
+
+  def check_suggestions_(self):
+    try:
+      candidates, error = self.suggestion_queue.get_nowait()
+    except Queue.Empty:
+      self.root.after(self.poll_interval, self.check_suggestions_)
+      return
+
+    if error is not None:
+      print("Failed to find candidate anchors: {}".format(error),
+            file=sys.stderr)
+      return
+    self.suggestions = [candidates[:, k] for k in range(candidates.shape[1])]
+    print("Found {} candidate anchors; press 'y' to accept or 'n' to reject "
+          "the one shown.".format(len(self.suggestions)))
+    self.update_suggestions_()
+
+  def update_suggestions_(self):
+    self.main_canvas.delete('suggestion')
+    if len(self.suggestions) == 0:
+      return
+    pos = self.suggestions[0][self.selected_i]
+    if not np.isfinite(pos).all():
+      return
+
+    cx, cy = self.image_to_canvas_(*pos)
+    r = 2*self.anchor_size
+    self.main_canvas.create_rectangle(cx - r, cy - r, cx + r, cy + r,
+        outline='#d80', width=2, tags='suggestion')
+    self.main_canvas.create_text(cx + r + 3, cy + r, anchor=tk.NW,
+        text="y/n? ({} left)".format(len(self.suggestions)),
+        font=('Helvetica', 9), fill='#d80', tags='suggestion')
+
+  def accept_suggestion_(self):
+    # turn the shown candidate into a regular anchor, and select it
+    if len(self.suggestions) == 0:
+      return
+    positions = self.suggestions.pop(0)
+    self.n_accepted += 1
+    self.tag_frame.add_tag("auto #{}".format(self.n_accepted))
+    k = len(self.tag_frame.tags) - 1
+    for i, pos in enumerate(positions):
+      if np.isfinite(pos).all():
+        self.tag_frame.update_some_anchor(i, k, (round(pos[0], 2),
+                                                 round(pos[1], 2)))
+    self.tag_frame.set_selected_idx(k + 1)
+    self.delete_anchors()
+    self.add_anchors()
+
+  def reject_suggestion_(self):
+    if len(self.suggestions) > 0:
+      self.suggestions.pop(0)
+      self.update_suggestions_()
+
   def finalize_(self):
-    if self.thumb_loader is not None and self.thumb_loader.is_alive():
-      self.thumb_loader.terminate()
+    if self.loader is not None:
+      self.loader.stop()
+    if self.metadata_pool is not None:
+      self.metadata_pool.terminate()
+    self.thumb_cache.close()
+    self.metadata.close()
+
+    # leave a complete anchors file behind
+    if self.journal is not None:
+      self.tag_frame.save_tags(wait=True)
+      self.journal.close()
+
+  def show_thumb_(self, i, img):
+    self.thumb_photos[i] = ImageTk.PhotoImage(img)
+    if i in self.thumb_items:
+      self.thumbnails.itemconfig(self.thumb_items[i][2],
+                                 image=self.thumb_photos[i])
 
   def del_win_handler_(self):
     self.finalize_()
     self.root.destroy()
 
-  def check_new_thumb_(self):
-    if self.thumb_pipe is not None:
-      if self.thumb_pipe[0].poll():
-        img_src = self.thumb_pipe[0].recv()
-        img0 = Image.frombytes(img_src['mode'], img_src['size'],
-                               img_src['pixels'])
-
-        i = img_src['i']
-        self.thumb_handles[i] = ImageTk.PhotoImage(img0)
-
-        pos = self.thumb_pos[i]
-        self.thumbnails.create_image(pos[0], pos[1], anchor=tk.NW,
-                                 image=self.thumb_handles[i])
-        self.root.update_idletasks()
+  def watch_pipe_(self, conn, callback):
+    # call `callback` whenever `conn` has data to read; Tk's file handlers
+    # wake up the main loop as soon as data arrives, but they only exist on
+    # Unix, so elsewhere we fall back to polling
+    fd = conn.fileno()
+    try:
+      self.root.tk.createfilehandler(fd, tk.READABLE,
+                                     lambda fd, mask: callback())
+      self.pipe_watchers[fd] = None
+    except (AttributeError, tk.TclError):
+      def poll():
+        self.pipe_watchers[fd] = self.root.after(self.poll_interval, poll)
+        if conn.poll():
+          callback()
+      self.pipe_watchers[fd] = self.root.after(self.poll_interval, poll)
+
+  def unwatch_pipe_(self, conn):
+    fd = conn.fileno()
+    if fd not in self.pipe_watchers:
+      return
 
-    # stop checking once all images have been loaded
-    if any(_ == None for _ in self.thumb_handles):
-      self.check_thumb_alarm = self.root.after(100, self.check_new_thumb_)
+    alarm = self.pipe_watchers.pop(fd)
+    if alarm is None:
+      self.root.tk.deletefilehandler(fd)
     else:
-      print("Finished loading thumbnails.")
-
-  def check_image_ready_(self):
-    if self.image_pipe is not None:
-      if self.image_pipe[0].poll():
-        img_src = self.image_pipe[0].recv()
-        img0 = Image.frombytes(img_src['mode'], img_src['size'],
-                               img_src['pixels'])
-
-        i = img_src['i']
-        self.main_image_handle = ImageTk.PhotoImage(img0)
+      self.root.after_cancel(alarm)
+
+  def show_main_image_(self, img):
+    self.main_image = img
+    self.main_image_handle = ImageTk.PhotoImage(img)
+    self.render_view_()
+
+  def get_view_(self):
+    # (ox, oy, scale) such that image pixel (x, y) is centered on canvas
+    # position (ox + (x + 0.5)*scale, oy + (y + 0.5)*scale)
+    if self.view_scale is None:
+      im_w = self.img_sizes[self.selected_i][0]
+      rect = self.main_rectangle
+      return (rect[0], rect[1], float(rect[2] - rect[0])/im_w)
+    return (self.view_origin[0], self.view_origin[1], self.view_scale)
+
+  def image_to_canvas_(self, x, y):
+    ox, oy, scale = self.get_view_()
+    return (ox + (x + 0.5)*scale - 0.5, oy + (y + 0.5)*scale - 0.5)
+
+  def canvas_to_image_(self, cx, cy):
+    ox, oy, scale = self.get_view_()
+    return ((cx + 0.5 - ox)/scale - 0.5, (cy + 0.5 - oy)/scale - 0.5)
+
+  def get_view_tiles_(self):
+    # pyramid level for the current zoom, and the canvas rectangles of the
+    # tiles from that level that are in view
+    ox, oy, scale = self.get_view_()
+    levels = get_pyramid_levels(self.img_sizes[self.selected_i])
+    level = int(math.floor(math.log(1.0/scale, 2))) if scale < 1 else 0
+    level = min(max(level, 0), len(levels) - 1)
+
+    # level pixels to canvas pixels, along each axis
+    level_w, level_h = levels[level]
+    sx = scale*levels[0][0]/level_w
+    sy = scale*levels[0][1]/level_h
+
+    # past the full resolution, tiles are cut from smaller parts of level 0,
+    # so that none is more than twice PYRAMID_TILE on the canvas
+    tile = PYRAMID_TILE
+    if level == 0 and scale > 1:
+      tile = max(PYRAMID_TILE >> int(math.floor(math.log(scale, 2))), 1)
+    tx0 = max(int((0 - ox)/sx)//tile, 0)
+    tx1 = min(int(math.ceil((self.main_canvas_width - ox)/sx/tile)),
+              (level_w + tile - 1)//tile)
+    ty0 = max(int((0 - oy)/sy)//tile, 0)
+    ty1 = min(int(math.ceil((self.main_canvas_height - oy)/sy/tile)),
+              (level_h + tile - 1)//tile)
+
+    tiles = []
+    for ty in range(ty0, ty1):
+      for tx in range(tx0, tx1):
+        x0 = int(round(ox + tx*tile*sx))
+        y0 = int(round(oy + ty*tile*sy))
+        x1 = int(round(ox + min((tx + 1)*tile, level_w)*sx))
+        y1 = int(round(oy + min((ty + 1)*tile, level_h)*sy))
+        if x1 > x0 and y1 > y0:
+          tiles.append(((self.selected_i, level, tx, ty, tile, x1 - x0,
+                         y1 - y0), (x0, y0)))
+    return tiles
+
+  def add_tile_photo_(self, key, img):
+    # keys end with the tile's size on the canvas
+    old = self.tile_photos.pop(key, None)
+    if old is not None:
+      self.tile_bytes -= 4*key[-2]*key[-1]
+    self.tile_photos[key] = ImageTk.PhotoImage(img)
+    self.tile_bytes += 4*key[-2]*key[-1]
+    self.evict_tile_photos_()
+
+  def evict_tile_photos_(self):
+    while self.tile_bytes > self.max_tile_bytes and len(self.tile_photos) > 0:
+      key, _ = self.tile_photos.popitem(last=False)
+      self.tile_bytes -= 4*key[-2]*key[-1]
+
+  def place_tile_(self, key, pos):
+    item = self.main_canvas.create_image(pos[0], pos[1], anchor=tk.NW,
+                                         image=self.tile_photos[key])
+    # tiles go above the low-resolution backdrop, below everything else
+    self.main_canvas.tag_lower(item)
+    if self.main_image_item is not None:
+      self.main_canvas.tag_lower(self.main_image_item)
+    self.tile_items[key] = item
+
+  def render_view_(self):
+    self.view_update_pending = False
+    for item in self.tile_items.values():
+      self.main_canvas.delete(item)
+    self.tile_items = {}
+    if self.main_image_item is not None:
+      self.main_canvas.delete(self.main_image_item)
+      self.main_image_item = None
+
+    ox, oy, scale = self.get_view_()
+    im_w, im_h = self.img_sizes[self.selected_i]
+    if self.main_rect_handle is not None:
+      self.main_canvas.coords(self.main_rect_handle,
+          (int(round(ox)) - 1, int(round(oy)) - 1,
+           int(round(ox + im_w*scale)), int(round(oy + im_h*scale))))
+
+    if self.view_scale is None:
+      if self.main_image_handle is not None:
+        pos = self.main_rectangle
+        self.main_image_item = self.main_canvas.create_image(pos[0], pos[1],
+            anchor=tk.NW, image=self.main_image_handle)
+        self.main_canvas.tag_lower(self.main_image_item)
+    else:
+      # stretch the whole-image view as a placeholder until the tiles arrive
+      if self.main_image is not None:
+        x0 = max(int(math.floor(ox)), 0)
+        y0 = max(int(math.floor(oy)), 0)
+        x1 = min(int(math.ceil(ox + im_w*scale)), self.main_canvas_width)
+        y1 = min(int(math.ceil(oy + im_h*scale)), self.main_canvas_height)
+        if x1 > x0 and y1 > y0:
+          fit = float(self.main_image.size[0])/im_w/scale
+          backdrop = self.main_image.transform((x1 - x0, y1 - y0),
+              Image.EXTENT, ((x0 - ox)*fit, (y0 - oy)*fit,
+                             (x1 - ox)*fit, (y1 - oy)*fit), Image.BILINEAR)
+          self.backdrop_handle = ImageTk.PhotoImage(backdrop)
+          self.main_image_item = self.main_canvas.create_image(x0, y0,
+              anchor=tk.NW, image=self.backdrop_handle)
+          self.main_canvas.tag_lower(self.main_image_item)
+
+      # tiles we have are shown right away, the others are requested from
+      # the center of the view outwards
+      self.loader.cancel(MAIN, kind='tile')
+      missing = []
+      for key, pos in self.get_view_tiles_():
+        if key in self.tile_photos:
+          self.tile_photos[key] = self.tile_photos.pop(key)
+          self.place_tile_(key, pos)
+        else:
+          missing.append((key, pos))
+
+      center = (self.main_canvas_width/2, self.main_canvas_height/2)
+      missing.sort(key=lambda _: (_[1][0] + _[0][5]/2 - center[0])**2 +
+                                 (_[1][1] + _[0][6]/2 - center[1])**2)
+      for key, pos in missing:
+        self.loader.submit(MAIN, 'tile', self.selected_i, key[5:],
+                           data=key[1:5])
+
+      self.evict_tile_photos_()
 
-        pos = img_src['pos']
-        self.main_canvas.create_image(pos[0], pos[1], anchor=tk.NW,
-                                      image=self.main_image_handle)
-        self.root.update_idletasks()
-        print("Finished loading image {} ({})".format(i+1, self.files[i]))
+    self.delete_anchors()
+    self.add_anchors()
 
-        self.add_anchors()
+  def schedule_render_view_(self):
+    # coalesce bursts of zoom and pan events into a single redraw
+    if not self.view_update_pending:
+      self.view_update_pending = True
+      self.root.after_idle(self.render_view_)
+
+  def set_zoom_(self, scale, cx, cy):
+    # zoom to `scale`, keeping the image point under canvas (cx, cy) in place
+    # zooming out past the whole image goes back to fitting it
+    ox, oy, old_scale = self.get_view_()
+    fit_scale = self.get_view_fit_scale_()
+    scale = min(scale, self.max_view_scale)
+    if scale <= fit_scale:
+      if self.view_scale is None:
         return
+      self.view_scale = None
+    else:
+      self.view_origin = (cx - (cx - ox)*scale/old_scale,
+                          cy - (cy - oy)*scale/old_scale)
+      self.view_scale = scale
+    self.schedule_render_view_()
+
+  def get_view_fit_scale_(self):
+    im_w = self.img_sizes[self.selected_i][0]
+    return float(self.main_rectangle[2] - self.main_rectangle[0])/im_w
+
+  def zoom_callback_(self, event):
+    if event.num == 4 or getattr(event, 'delta', 0) > 0:
+      factor = self.zoom_step
+    else:
+      factor = 1.0/self.zoom_step
+    scale = self.get_view_()[2]
+    self.set_zoom_(scale*factor, self.main_canvas.canvasx(event.x),
+                   self.main_canvas.canvasy(event.y))
 
-    self.check_image_alarm = self.root.after(100, self.check_image_ready_)
+  def pan_start_callback_(self, event):
+    self.pan_start = (event.x, event.y)
 
-  def update_main_rectangle_(self, i):
-    if self.selected_i == i and self.main_rect_handle is not None:
+  def pan_callback_(self, event):
+    if self.view_scale is None or self.pan_start is None:
       return
-
-    if self.main_loader is not None:
-      self.main_loader.terminate()
-
-    if self.check_image_alarm is not None:
-      self.root.after_cancel(self.check_image_alarm)
-    self.check_image_alarm = self.root.after(100, self.check_image_ready_)
-
-    self.selected_i = i
-    img_width, img_height = self.img_sizes[self.selected_i]
+    dx = event.x - self.pan_start[0]
+    dy = event.y - self.pan_start[1]
+    self.pan_start = (event.x, event.y)
+    self.view_origin = (self.view_origin[0] + dx, self.view_origin[1] + dy)
+    self.schedule_render_view_()
+
+  def check_loader_(self, k):
+    # handle whatever worker `k` finished
+    for task, img0, error in self.loader.receive(k):
+      i = task['i']
+      if error is not None:
+        print("Failed to load {}: {}".format(self.files[i], error),
+              file=sys.stderr)
+        if task['kind'] == 'keypoints':
+          self.keypoints_done_(i, None)
+      elif task['kind'] == 'keypoints':
+        self.keypoints_done_(i, img0)
+      elif task['kind'] == 'thumb':
+        self.thumb_cache.put(self.files[i], task['size'], img0)
+        if i in self.thumb_items:
+          self.show_thumb_(i, img0)
+      elif task['kind'] == 'tile':
+        key = (i,) + task['data'] + task['size']
+        self.add_tile_photo_(key, img0)
+        if (i == self.selected_i and self.view_scale is not None and
+            key not in self.tile_items):
+          for key1, pos in self.get_view_tiles_():
+            if key1 == key:
+              self.place_tile_(key, pos)
+      else:
+        self.image_cache.put((i, task['data']), img0)
+
+        # prefetched images are shown as well if the user already got to
+        # them
+        if (i == self.selected_i and task['data'] == self.main_rectangle and
+            self.main_image_handle is None):
+          print("Finished loading image {} ({})".format(i+1, self.files[i]))
+          self.show_main_image_(img0)
+
+      if task['kind'] == 'thumb' and i in self.thumbs_requested:
+        self.thumbs_requested.discard(i)
+        if len(self.thumbs_requested) == 0:
+          self.thumb_cache.flush()
+
+  def get_main_rectangle_(self, i):
+    img_width, img_height = self.img_sizes[i]
     ratio = min(float(self.main_canvas_width - self.main_spacing)/img_width,
                 float(self.main_canvas_height - self.main_spacing)/img_height)
 
     disp_width = int(img_width*ratio)
     disp_height = int(img_height*ratio)
 
-    self.main_rectangle = (
-        (self.main_canvas_width - disp_width)/2,
-        (self.main_canvas_height - disp_height)/2,
-        (self.main_canvas_width + disp_width)/2,
-        (self.main_canvas_height + disp_height)/2)
+    return ((self.main_canvas_width - disp_width)/2,
+            (self.main_canvas_height - disp_height)/2,
+            (self.main_canvas_width + disp_width)/2,
+            (self.main_canvas_height + disp_height)/2)
+
+  def get_rectangle_size_(self, rect):
+    return (rect[2] - rect[0], rect[3] - rect[1])
+
+  def prefetch_neighbors_(self, i):
+    # ask for the closest images first, ahead of the background thumbnails;
+    # this replaces whatever was still waiting to be prefetched
+    self.loader.cancel(BACKGROUND, kind='prefetch')
+    for k in range(1, self.prefetch_range + 1):
+      for j in (i + k, i - k):
+        if j >= 0 and j < len(self.files):
+          rect = self.get_main_rectangle_(j)
+          if (j, rect) not in self.image_cache:
+            self.loader.submit(BACKGROUND, 'prefetch', j,
+                               self.get_rectangle_size_(rect), data=rect)
+
+  def update_main_rectangle_(self, i, force=False):
+    if (not force and self.selected_i == i and
+        self.main_rect_handle is not None):
+      return
 
-    self.delete_anchors()
-    if self.main_image_handle is not None:
-      self.main_canvas.delete(self.main_image_handle)
-      self.main_image_handle = None
-            
-    print("Starting loading file {} ({}).".format(i+1, self.files[i]))
-    self.image_pipe = Pipe()
-    self.main_loader = Process(
-        target=load_image, args=(self.files[i], i, self.main_rectangle,
-        self.image_pipe[1]))
-    self.main_loader.start()
+    # the previously selected image is not needed anymore
+    self.loader.cancel(MAIN)
 
-    if self.main_rect_handle is not None:
-      self.main_canvas.delete(self.main_rect_handle)
-      self.main_rect_handle = None
+    # stay zoomed in on the same spot when moving between images of the same
+    # size
+    if (self.selected_i < 0 or
+        self.img_sizes[i] != self.img_sizes[self.selected_i]):
+      self.view_scale = None
 
-    rect = (self.main_rectangle[0]-1, self.main_rectangle[1]-1,
-            self.main_rectangle[2], self.main_rectangle[3])
-    self.main_rect_handle = self.main_canvas.create_rectangle(rect)
+    self.selected_i = i
+    self.main_rectangle = self.get_main_rectangle_(i)
+
+    self.main_image = None
+    self.main_image_handle = None
+    if self.main_rect_handle is None:
+      self.main_rect_handle = self.main_canvas.create_rectangle((0, 0, 0, 0))
+
+    img0 = self.image_cache.get((i, self.main_rectangle))
+    if img0 is not None:
+      self.show_main_image_(img0)
+    else:
+      self.render_view_()
+      print("Starting loading file {} ({}).".format(i+1, self.files[i]))
+      self.loader.submit(MAIN, 'image', i,
+                         self.get_rectangle_size_(self.main_rectangle),
+                         data=self.main_rectangle)
+
+    self.prefetch_neighbors_(i)
 
-    day = (self.img_dates[i] - self.img_dates[0]).days + 1
-    title = "{}. Day {}".format(i+1, day)
     self.root.title("image aligner ({}, {})".format(
-        title, os.path.basename(self.files[self.selected_i])))
+        self.get_title_(i), os.path.basename(self.files[self.selected_i])))
 
   def thumbnail_click_callback_(self, event):
     self.main_canvas.focus_set()
     cx = self.thumbnails.canvasx(event.x)
     cy = self.thumbnails.canvasy(event.y)
-    # XXX this is inefficient, but perhaps we don't care
-    clicked_on = None
-    for i, pos in enumerate(self.thumb_pos):
-      if (cx >= pos[0] and cy >= pos[1] and
-         cx - pos[0] < pos[2] and cy - pos[1] < pos[3]):
-        clicked_on = i
-        break
+    i = bisect.bisect_right(self.thumb_x, cx) - 1
+    if i < 0:
+      return
 
-    if clicked_on is not None:
+    pos = self.thumb_pos[i]
+    if (cx >= pos[0] and cy >= pos[1] and
+       cx - pos[0] < pos[2] and cy - pos[1] < pos[3]):
       self.update_main_rectangle_(i)
 
   def main_click_callback_(self, event):
@@ -436,19 +1066,23 @@ class Anchorer(object):
     cx = self.main_canvas.canvasx(event.x)
     cy = self.main_canvas.canvasy(event.y)
 
-    if self.main_image_handle is None or self.selected_i is None:
+    if self.selected_i is None or (self.view_scale is None and
+                                   self.main_image_handle is None):
       return    # image not loaded yet
 
-    if (cx < self.main_rectangle[0] or cy < self.main_rectangle[1] or
-        cx >= self.main_rectangle[2] or cy >= self.main_rectangle[3]):
-      return    # click outside image
-
     # convert to image coordinates
     im_w, im_h = self.img_sizes[self.selected_i]
-    rect_w = self.main_rectangle[2] - self.main_rectangle[0]
-    rect_h = self.main_rectangle[3] - self.main_rectangle[1]
-    x = int(float(cx - self.main_rectangle[0])*im_w/rect_w)
-    y = int(float(cy - self.main_rectangle[1])*im_h/rect_h)
+    x, y = self.canvas_to_image_(cx, cy)
+    if x < -0.5 or y < -0.5 or x >= im_w - 0.5 or y >= im_h - 0.5:
+      return    # click outside image
+
+    # whole pixels unless zoomed in enough for sub-pixel positions to matter
+    if self.get_view_()[2] > 1:
+      x = round(x, 2)
+      y = round(y, 2)
+    else:
+      x = int(round(x))
+      y = int(round(y))
 
     # draw anchor on screen
     selected_anchor_idx = self.tag_frame.get_selected_idx()
@@ -456,13 +1090,24 @@ class Anchorer(object):
 
     self.tag_frame.update_current_anchor(self.selected_i, (x, y))
 
+  def main_right_click_callback_(self, event):
+    # remove the selected anchor from the current image
+    event.widget.focus_set()
+    i0 = self.tag_frame.get_selected_idx()
+    if i0 is None or self.tag_frame.get_current_anchor(self.selected_i) is None:
+      return
+
+    self.tag_frame.update_current_anchor(self.selected_i, None)
+    if self.canvas_anchors is not None and self.canvas_anchors[i0] is not None:
+      for h in self.canvas_anchors[i0][2:]:
+        self.main_canvas.delete(h)
+      self.canvas_anchors[i0] = None
+
   def update_anchor(self, i0, x, y):
     # convert to canvas coordinates
-    im_w, im_h = self.img_sizes[self.selected_i]
-    rect_w = self.main_rectangle[2] - self.main_rectangle[0]
-    rect_h = self.main_rectangle[3] - self.main_rectangle[1]
-    cx = self.main_rectangle[0] + int(float(x)*rect_w/im_w)
-    cy = self.main_rectangle[1] + int(float(y)*rect_h/im_h)
+    cx, cy = self.image_to_canvas_(x, y)
+    cx = int(round(cx))
+    cy = int(round(cy))
 
     # check if this anchor already exists
     if self.canvas_anchors is None:
@@ -512,12 +1157,55 @@ class Anchorer(object):
       anchor = anchor_list[self.selected_i]
       if anchor is not None:
         self.update_anchor(i, *anchor)
+    self.update_feedback_()
+    self.update_suggestions_()
+
+  def update_feedback_(self):
+    # residual of every anchor in the current image, and the predicted
+    # position of the selected anchor, from the current estimate of the
+    # image's transformation
+    self.main_canvas.delete('feedback')
+    i = self.selected_i
+    if i == self.solver.reference or self.solver.anchors.shape[1] == 0:
+      return
+
+    residuals = self.solver.get_residuals(i)
+    for k, anchor_list in enumerate(self.tag_frame.anchors):
+      anchor = anchor_list[i]
+      if anchor is None or not np.isfinite(residuals[k]):
+        continue
+      cx, cy = self.image_to_canvas_(*anchor)
+      self.main_canvas.create_text(cx + self.anchor_size + 3,
+          cy - self.anchor_size, text="{:.1f}".format(residuals[k]),
+          anchor=tk.SW, font=('Helvetica', 9), tags='feedback',
+          fill=self.anchor_colors[k % len(self.anchor_colors)])
+
+    k = self.tag_frame.get_selected_idx()
+    predicted = self.solver.predict(i, k) if k is not None else None
+    if predicted is not None:
+      cx, cy = self.image_to_canvas_(*predicted)
+      r = 2*self.anchor_size
+      self.main_canvas.create_oval(cx - r, cy - r, cx + r, cy + r,
+          outline=self.anchor_colors[k % len(self.anchor_colors)],
+          dash=(3, 3), tags='feedback')
+
+  def set_anchor_callback(self, file_idx, anchor_idx, data):
+    self.solver.set_anchor(file_idx, anchor_idx, data)
+    if file_idx in (self.selected_i, self.solver.reference):
+      self.update_feedback_()
+
+  def reset_solver_(self):
+    state = [[anchor_list[i] for anchor_list in self.tag_frame.anchors]
+             for i in xrange(len(self.files))]
+    self.solver.reset(anchors_from_lists(state))
 
   def add_anchor_callback(self):
+    self.solver.add_anchor()
     self.delete_anchors()
     self.add_anchors()
 
   def del_anchor_callback(self):
+    self.reset_solver_()
     self.delete_anchors()
     self.add_anchors()
 
@@ -539,11 +1227,12 @@ class Anchorer(object):
     self.thumb_slider_height = (self.thumb_height + self.thumb_spacing/2 +
         self.thumb_title_size)
     self.thumbnails = tk.Canvas(self.bottom_frame, width=self.root_width,
-        height=self.thumb_slider_height, xscrollcommand=self.xscrollbar.set)
+        height=self.thumb_slider_height,
+        xscrollcommand=self.thumb_scroll_callback_)
     self.thumbnails.pack(side=tk.TOP)
     self.xscrollbar.config(command=self.thumbnails.xview)
 
-    self.draw_placeholders_()
+    self.layout_thumbs_()
 
     # XXX on Win: divide by 120; or just use the sign on both Mac&Win
     # XXX on Linux: bind to <Button-4> and <Button-5>, and divide or use sign
@@ -551,20 +1240,12 @@ class Anchorer(object):
       dx = -event.delta
       self.thumbnails.xview_scroll(int(dx), "units")
 
-    self.thumbnails.config(scrollregion=self.thumbnails.bbox(tk.ALL))
+    self.thumbnails.config(scrollregion=(0, 0, self.thumb_strip_width,
+                                         self.thumb_slider_height))
     root.bind_all("<Shift-MouseWheel>", on_mousewheel_x)
 
-    # start loading thumbnails in the background
-    self.check_thumb_alarm = self.root.after(100, self.check_new_thumb_)
-
     root.protocol("WM_DELETE_WINDOW", self.del_win_handler_)
 
-    self.thumb_pipe = Pipe()
-    self.thumb_loader = Process(target=load_thumbs, args=(self.files,
-                                    self.thumb_pos, self.thumb_pipe[1]))
-    print("Starting to load thumbnails.")
-    self.thumb_loader.start()
-
     # create picture canvas
     self.main_canvas_width = self.root_width - self.tags_width
     self.main_canvas_height = self.root_height - self.thumb_slider_height
@@ -572,53 +1253,78 @@ class Anchorer(object):
         height=self.main_canvas_height, highlightthickness=0)
     self.main_canvas.pack(side=tk.LEFT)
 
-    self.update_main_rectangle_(0)
-
-    self.thumbnails.bind("<Button-1>", self.thumbnail_click_callback_)
-    self.main_canvas.bind("<Button-1>", self.main_click_callback_)
-
     # create tag text entries
     self.tag_frame = TagFrame(master=self.top_frame,
         height=self.main_canvas_height, width=self.tags_width,
         n_files=len(self.files), add_callback=self.add_anchor_callback,
-        del_callback=self.del_anchor_callback, out_file=self.out_file)
+        del_callback=self.del_anchor_callback,
+        set_callback=self.set_anchor_callback, out_file=self.out_file)
     self.tag_frame.pack(side=tk.LEFT, fill=tk.BOTH)
 
+    # start the loader processes; each slot fits a main image or a thumbnail
+    slot_size = 4*max(self.main_canvas_width*self.main_canvas_height,
+                      self.max_thumb_width*self.thumb_height)
+    self.loader = LoaderPool(self.files, slot_size, self.n_workers,
+                             pyramid_dir=self.pyramid_dir,
+                             pyramid_max_bytes=self.pyramid_cache_size)
+    self.loader.start()
+    for k, conn in enumerate(self.loader.connections()):
+      self.watch_pipe_(conn, lambda k=k: self.check_loader_(k))
+
+    self.update_main_rectangle_(0)
+
+    # thumbnails are requested after the main image, which takes precedence
+    self.update_thumb_strip_()
+    self.refresh_image_data_()
+
+    self.thumbnails.bind("<Button-1>", self.thumbnail_click_callback_)
+    self.main_canvas.bind("<Button-1>", self.main_click_callback_)
+    self.main_canvas.bind("<Button-3>", self.main_right_click_callback_)
+
+    # zoom with the mouse wheel, pan by dragging with the middle button
+    self.main_canvas.bind("<MouseWheel>", self.zoom_callback_)
+    self.main_canvas.bind("<Button-4>", self.zoom_callback_)
+    self.main_canvas.bind("<Button-5>", self.zoom_callback_)
+    self.main_canvas.bind("<ButtonPress-2>", self.pan_start_callback_)
+    self.main_canvas.bind("<B2-Motion>", self.pan_callback_)
+
     def key_callback(event):
       if not isinstance(event.widget, tk.Entry):
         if event.char >= '0' and event.char <= '9':
           self.tag_frame.set_selected_idx(ord(event.char) - ord('0'))
+        elif event.char in ('+', '=', '-'):
+          factor = self.zoom_step if event.char != '-' else 1.0/self.zoom_step
+          self.set_zoom_(self.get_view_()[2]*factor,
+                         self.main_canvas_width/2, self.main_canvas_height/2)
+        elif event.keysym == 'Escape':
+          self.set_zoom_(0, 0, 0)
+        elif event.char == 'y':
+          self.accept_suggestion_()
+        elif event.char == 'n':
+          self.reject_suggestion_()
 #        print("pressed", repr(event.char))
 
     self.root.bind("<Key>", key_callback)
 
+    # the predicted position follows the selected anchor
+    self.tag_frame.radio_variable.trace('w',
+        lambda *args: self.update_feedback_())
+
   def run(self):
     tk.mainloop()
 
-def read_anchors(fname):
-  try:
-    with open(fname, 'rt') as f:
-      header = f.readline().strip()
-      anchor_names = [_.strip() for _ in header.split('\t')]
-      anchors = []
-      while True:
-        line = f.readline()
-        if len(line) == 0:
-          break
-
-        anchors_str = [_.strip() for _ in line.strip().split('\t')]
-        anchors_tup = [ast.literal_eval(_) for _ in anchors_str]
-        anchors.append(anchors_tup)
-  except IOError:
-    return (None, None)
-
-  return (anchor_names, anchors)
-
 if __name__ == "__main__":
   args = parse_command_line()
   files = args.files
 
-  app = Anchorer(args.files, out_file=args.output)
+  app = Anchorer(args.files, out_file=args.output, cache_dir=args.cache_dir,
+                 cache_size=args.cache_size*1024*1024,
+                 image_cache_size=args.image_cache_size*1024*1024,
+                 n_workers=args.workers,
+                 pyramid_cache_size=args.pyramid_cache_size*1024*1024,
+                 n_suggestions=args.suggest)
   app.setup()
-  app.init_anchors(*read_anchors(args.output))
+  app.load_anchors()
+  if app.n_suggestions > 0:
+    app.start_suggestions_()
   app.run()
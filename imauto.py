@@ -0,0 +1,310 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import argparse
+import itertools
+import sys
+
+from multiprocessing import Pool
+
+import numpy as np
+import scipy.ndimage
+from PIL import Image
+
+from imio import read_anchor_array, write_trafo_array
+from imoptim import get_anchor_weights, get_best_trafos, trafo_params
+from imrefine import phase_correlate
+
+# Align an image set without anchors. Every frame is compared to the
+# reference frame on a small pyramid of grayscale images, coarsest first.
+# At each level the frame is warped with the current estimate, the
+# remaining rotation and scale are found by phase correlation of the
+# log-polar resampled Fourier magnitudes (Fourier-Mellin), and then the
+# remaining shift by phase correlation of the images themselves. The
+# result is written in the same a, b, dx, dy format imoptim produces.
+
+def parse_command_line():
+  parser = argparse.ArgumentParser(
+    description="Find transformations aligning an image set, without "
+                "anchors.",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('files', type=str, nargs='+',
+                      help="a file in the image set")
+  parser.add_argument('-o', '--output', default='img_params.txt',
+                      help="where to store the transformation parameters")
+  parser.add_argument('-r', '--reference', type=int, default=0,
+                      help="index of the image that all others are aligned "
+                          +"to")
+  parser.add_argument('-a', '--anchors', default=None,
+                      help="file containing anchor positions; frames that "
+                          +"cannot be aligned automatically use these "
+                          +"instead")
+  parser.add_argument('--prefer-anchors', action='store_true',
+                      help="use the anchors for every frame that has at "
+                          +"least two of them in common with the reference")
+  parser.add_argument('-s', '--size', type=int, default=1024,
+                      help="longer side of the reference image at the finest "
+                          +"level of the pyramid")
+  parser.add_argument('-l', '--levels', type=int, default=3,
+                      help="number of pyramid levels, each half the size of "
+                          +"the next")
+  parser.add_argument('--min-score', type=float, default=0.05,
+                      help="smallest phase-correlation peak for which an "
+                          +"alignment is accepted")
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help="number of frames to align in parallel")
+
+  args = parser.parse_args()
+
+  return args
+
+def read_pyramid(fname, scales):
+  # grayscale versions of an image at the given scales, made from a single
+  # draft-mode decode; returns a list of (pixels, scale matrix) pairs
+  img = Image.open(fname)
+  full_size = img.size
+  largest = max(scales)
+  img.draft('L', (int(full_size[0]*largest), int(full_size[1]*largest)))
+  img = img.convert('L')
+
+  levels = []
+  for scale in scales:
+    size = (max(int(round(full_size[0]*scale)), 1),
+            max(int(round(full_size[1]*scale)), 1))
+    level = img.resize(size, resample=Image.BOX) if size != img.size else img
+    levels.append((np.asarray(level, dtype=np.float32),
+                   get_scale_matrix(float(size[0])/full_size[0],
+                                    float(size[1])/full_size[1])))
+  return levels
+
+def get_scale_matrix(sx, sy):
+  # full-resolution pixel coordinates to those of a scaled image
+  return np.asarray([[sx, 0, 0.5*sx - 0.5], [0, sy, 0.5*sy - 0.5],
+                     [0, 0, 1.0]])
+
+def get_similarity(angle, scale, center):
+  # rotation by `angle` and scaling about `center`, in the a, b, dx, dy
+  # convention of imoptim
+  a = scale*np.cos(angle)
+  b = scale*np.sin(angle)
+  cx, cy = center
+  return np.asarray([[a, b, cx - a*cx - b*cy], [-b, a, cy + b*cx - a*cy],
+                     [0, 0, 1.0]])
+
+def warp(img, matrix, shape):
+  # resample `img` onto the reference grid, with `matrix` mapping image
+  # coordinates to reference coordinates; the outside is filled with the
+  # mean, which the window then fades out
+  inverse = np.linalg.inv(matrix)
+  # scipy works with (row, column) coordinates
+  swap = np.asarray([[0, 1, 0], [1, 0, 0], [0, 0, 1.0]])
+  inverse = np.dot(swap, np.dot(inverse, swap))
+  return scipy.ndimage.affine_transform(img, inverse[:2, :2],
+      offset=inverse[:2, 2], output_shape=shape, order=1,
+      cval=float(img.mean()))
+
+def get_window(shape):
+  return np.outer(np.hanning(shape[0]), np.hanning(shape[1]))
+
+def get_spectrum(img, window):
+  return np.fft.rfft2((img - img.mean())*window)
+
+# size of the log-polar maps of the Fourier magnitudes, as (angles, radii);
+# the angles cover half a turn, since the magnitudes are symmetric
+LOG_POLAR_SHAPE = (256, 128)
+
+def get_log_polar(img, window):
+  # high-pass filtered Fourier magnitude of an image, resampled on a
+  # log-polar grid in physical frequency, so that rotations and scalings of
+  # the image become shifts
+  height, width = img.shape
+  magnitude = np.abs(np.fft.fftshift(np.fft.fft2((img - img.mean())*window)))
+  fy = np.fft.fftshift(np.fft.fftfreq(height))[:, None]
+  fx = np.fft.fftshift(np.fft.fftfreq(width))[None, :]
+  cos_prod = np.cos(np.pi*fx)*np.cos(np.pi*fy)
+  magnitude *= (1 - cos_prod)*(2 - cos_prod)
+
+  n_angles, n_radii = LOG_POLAR_SHAPE
+  angles = np.arange(n_angles)*np.pi/n_angles
+  radii = np.exp(np.linspace(np.log(2.0/min(height, width)), np.log(0.5),
+                             n_radii))
+  rows = height//2 + radii[None, :]*np.sin(angles)[:, None]*height
+  cols = width//2 + radii[None, :]*np.cos(angles)[:, None]*width
+  log_polar = scipy.ndimage.map_coordinates(magnitude, [rows, cols], order=1)
+  return (log_polar, np.log(radii[1]/radii[0]))
+
+# the angles wrap around, the radii do not
+LOG_POLAR_WINDOW = np.hanning(LOG_POLAR_SHAPE[1])[None, :]
+
+def match_rotation(img, ref_lp_spectrum, window):
+  # rotation and scale about the center turning `img` into the reference,
+  # given the spectrum of the reference's log-polar map; the angle is only
+  # known up to half a turn
+  img_lp, log_step = get_log_polar(img, window)
+  shift = phase_correlate(get_spectrum(img_lp, LOG_POLAR_WINDOW),
+                          ref_lp_spectrum, shape=LOG_POLAR_SHAPE)[0]
+  angle = shift[1]*np.pi/LOG_POLAR_SHAPE[0]
+  scale = np.exp(shift[0]*log_step)
+  return (angle, scale)
+
+def match_shift(img, ref, window, ref_spectrum=None):
+  # shift turning `img` into `ref`, and the height of the correlation peak
+  if ref_spectrum is None:
+    ref_spectrum = get_spectrum(ref, window)
+  shift, score = phase_correlate(get_spectrum(img, window), ref_spectrum,
+                                 shape=ref.shape)
+  return (-shift, float(score))
+
+def get_fft_size(n):
+  # largest length up to n with no prime factors above 5, for which FFTs
+  # are fast
+  while True:
+    m = n
+    for p in (2, 3, 5):
+      while m % p == 0:
+        m //= p
+    if m == 1:
+      return n
+    n -= 1
+
+# the reference pyramid, loaded once per worker process
+reference_levels = None
+
+def init_worker(ref_file, scales):
+  global reference_levels
+  reference_levels = []
+  for ref, ref_scale in read_pyramid(ref_file, scales):
+    # frames are compared on the top-left part of the reference whose size
+    # suits the FFT
+    ref = ref[:get_fft_size(ref.shape[0]), :get_fft_size(ref.shape[1])]
+    window = get_window(ref.shape)
+    ref_lp = get_log_polar(ref, window)[0]
+    reference_levels.append((ref, ref_scale, window,
+                             get_spectrum(ref, window),
+                             get_spectrum(ref_lp, LOG_POLAR_WINDOW)))
+
+def align_frame(job):
+  # errors are returned instead of raised, so that a bad file only loses its
+  # own frame, as in imtransform
+  try:
+    return align_frame_(job)
+  except Exception as e:
+    return (None, 0.0, "{}: {}".format(type(e).__name__, e))
+
+def align_frame_(job):
+  # matrix taking the frame to the reference, at full resolution, and the
+  # correlation score at the finest level
+  fname, scales, passes = job
+  matrix = np.eye(3)
+  score = 0.0
+  levels = read_pyramid(fname, scales)
+
+  for level, ((img, img_scale), (ref, ref_scale, window, ref_spectrum,
+                                 ref_lp_spectrum)) in \
+      enumerate(zip(levels, reference_levels)):
+    # the estimate, in the coordinates of this level
+    scaled = np.dot(ref_scale, np.dot(matrix, np.linalg.inv(img_scale)))
+    center = ((ref.shape[1] - 1)/2.0, (ref.shape[0] - 1)/2.0)
+
+    angle, scale = match_rotation(warp(img, scaled, ref.shape),
+                                  ref_lp_spectrum, window)
+    if level == 0:
+      # the Fourier magnitudes cannot tell a rotation from one half a turn
+      # further; keep whichever gives the better match
+      candidates = [np.dot(get_similarity(angle + _, scale, center), scaled)
+                    for _ in (0, np.pi)]
+      scores = [match_shift(warp(img, _, ref.shape), ref, window,
+                            ref_spectrum)[1] for _ in candidates]
+      scaled = candidates[int(np.argmax(scores))]
+    else:
+      scaled = np.dot(get_similarity(angle, scale, center), scaled)
+
+    # windowing biases the shift towards zero, so it is found a few times
+    for _ in range(passes):
+      shift, score = match_shift(warp(img, scaled, ref.shape), ref, window,
+                                 ref_spectrum)
+      scaled[:2, 2] += shift
+
+    matrix = np.dot(np.linalg.inv(ref_scale), np.dot(scaled, img_scale))
+
+  return (matrix, score, None)
+
+def get_params(matrix):
+  # nearest a, b, dx, dy to a matrix
+  return np.asarray([(matrix[0, 0] + matrix[1, 1])/2,
+                     (matrix[0, 1] - matrix[1, 0])/2,
+                     matrix[0, 2], matrix[1, 2]])
+
+def align_frames(files, reference=0, size=1024, n_levels=3, passes=2,
+                 jobs=1):
+  # returns the a, b, dx, dy values as an (n_images, 4) array, and the
+  # correlation score of each frame (None where a frame cannot be read)
+  ref_size = Image.open(files[reference]).size
+  finest = float(size)/max(ref_size)
+  scales = [min(finest/2**_, 1.0) for _ in reversed(range(n_levels))]
+
+  jobs_list = [(_, scales, passes) for _ in files]
+  if jobs > 1:
+    pool = Pool(jobs, initializer=init_worker,
+                initargs=(files[reference], scales))
+    results = pool.imap(align_frame, jobs_list)
+  else:
+    pool = None
+    init_worker(files[reference], scales)
+    results = itertools.imap(align_frame, jobs_list)
+
+  params = np.zeros((len(files), 4))
+  scores = []
+  try:
+    for i, (matrix, score, error) in enumerate(results):
+      if error is not None:
+        sys.stderr.write("WARNING: skipping {}: {}\n".format(files[i],
+                                                              error))
+        params[i] = (1, 0, 0, 0)
+        scores.append(None)
+        continue
+      params[i] = get_params(matrix)
+      scores.append(score)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+  # the reference is exact by definition
+  params[reference] = (1, 0, 0, 0)
+  scores[reference] = 1.0
+  return (params, scores)
+
+if __name__ == "__main__":
+  args = parse_command_line()
+  files = list(args.files)
+  files.sort()
+
+  params, scores = align_frames(files, reference=args.reference,
+      size=args.size, n_levels=args.levels, jobs=args.jobs)
+  failed = np.asarray([_ is None or _ < args.min_score for _ in scores])
+
+  # anchors, where there are enough, take over from failed frames
+  from_anchors = np.zeros(len(files), dtype=bool)
+  if args.anchors is not None:
+    anchors = read_anchor_array(args.anchors)[1]
+    if anchors is None or len(anchors) != len(files):
+      sys.exit("The anchors in {} do not match the {} files.".format(
+          args.anchors, len(files)))
+    anchor_params = get_best_trafos(anchors, anchors[args.reference])[0]
+    usable = get_anchor_weights(anchors, anchors[args.reference]) > 0
+    enough = usable.sum(axis=-1) >= 2
+    from_anchors = enough & (failed | args.prefer_anchors)
+    from_anchors[args.reference] = False
+    params[from_anchors] = anchor_params[from_anchors]
+
+  # like imoptim, undetermined images get the identity transform
+  for i in np.flatnonzero(failed & ~from_anchors):
+    sys.stderr.write("WARNING: could not align image {} ({}); it needs "
+                     "anchors.\n".format(i+1, files[i]))
+    params[i] = (1, 0, 0, 0)
+  print("Aligned {} of {} images automatically, {} from anchors.".format(
+      (~failed & ~from_anchors).sum(), len(files), from_anchors.sum()))
+
+  write_trafo_array(args.output, trafo_params, params)
@@ -0,0 +1,376 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import collections
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sqlite3
+import time
+
+import numpy as np
+from PIL import Image
+
+from imio import replace_file
+
+def get_default_cache_dir():
+  return os.path.join(os.path.expanduser('~'), '.cache', 'imalign')
+
+class ThumbCache(object):
+  # Persistent store for thumbnails. All pixel data lives in one packed file
+  # that is memory-mapped for reading; a small JSON index maps each key (path,
+  # file size, modification time and thumbnail size) to the offset, size and
+  # mode of its pixels. Only the process that owns the cache writes to it.
+  # When the packed file grows beyond max_bytes, the least recently used
+  # thumbnails are dropped and the file is rewritten.
+  def __init__(self, cache_dir=None, max_bytes=512*1024*1024,
+               name='thumbs'):
+    if cache_dir is None:
+      cache_dir = get_default_cache_dir()
+    self.data_path = os.path.join(cache_dir, name + '.bin')
+    self.index_path = os.path.join(cache_dir, name + '.idx')
+    self.max_bytes = max_bytes
+
+    self.index = {}
+    self.data_file = None
+    self.data_map = None
+    self.dirty = False
+
+    try:
+      if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+      with open(self.index_path, 'rt') as f:
+        self.index = json.load(f)
+    except (IOError, OSError, ValueError):
+      self.index = {}
+
+    try:
+      self.data_file = open(self.data_path, 'a+b')
+    except IOError:
+      # cache unusable; everything will simply be a miss
+      self.data_file = None
+      self.index = {}
+      return
+
+    # drop entries that point past the end of the data (e.g., after a crash)
+    size = os.path.getsize(self.data_path)
+    self.index = {key: entry for key, entry in self.index.items()
+                  if entry['offset'] + entry['nbytes'] <= size}
+
+  def get_key(self, fname, size):
+    try:
+      stat = os.stat(fname)
+    except OSError:
+      return None
+    return "{}|{}|{!r}|{}x{}".format(os.path.abspath(fname), stat.st_size,
+                                     stat.st_mtime, size[0], size[1])
+
+  def map_(self, end):
+    # (re)map the data file if it grew since it was last mapped
+    if self.data_map is None or len(self.data_map) < end:
+      if self.data_map is not None:
+        self.data_map.close()
+      self.data_file.flush()
+      self.data_map = mmap.mmap(self.data_file.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+
+  def get(self, fname, size):
+    # return the cached thumbnail as a PIL image, or None
+    if self.data_file is None:
+      return None
+    key = self.get_key(fname, size)
+    entry = self.index.get(key)
+    if entry is None:
+      return None
+
+    offset = entry['offset']
+    end = offset + entry['nbytes']
+    self.map_(end)
+    entry['used'] = time.time()
+    self.dirty = True
+    return Image.frombytes(entry['mode'], tuple(entry['size']),
+                           self.data_map[offset:end])
+
+  def put(self, fname, size, img):
+    if self.data_file is None:
+      return
+    key = self.get_key(fname, size)
+    if key is None:
+      return
+
+    pixels = img.tobytes()
+    self.data_file.seek(0, os.SEEK_END)
+    offset = self.data_file.tell()
+    self.data_file.write(pixels)
+    self.index[key] = {'offset': offset, 'nbytes': len(pixels),
+                       'mode': img.mode, 'size': list(img.size),
+                       'used': time.time()}
+    self.dirty = True
+
+    if offset + len(pixels) > self.max_bytes:
+      self.evict_()
+
+  def evict_(self):
+    # keep the most recently used thumbnails, up to 3/4 of the maximum size,
+    # and rewrite the packed file with only those
+    keys = sorted(self.index.keys(), key=lambda _: -self.index[_]['used'])
+    kept = []
+    total = 0
+    for key in keys:
+      total += self.index[key]['nbytes']
+      if total > 3*self.max_bytes//4:
+        break
+      kept.append(key)
+
+    self.map_(os.path.getsize(self.data_path))
+    tmp_path = self.data_path + '.tmp'
+    new_index = {}
+    with open(tmp_path, 'wb') as f:
+      for key in kept:
+        entry = dict(self.index[key])
+        start = entry['offset']
+        data = self.data_map[start:start + entry['nbytes']]
+        entry['offset'] = f.tell()
+        f.write(data)
+        new_index[key] = entry
+
+    self.data_map.close()
+    self.data_map = None
+    self.data_file.close()
+    replace_file(tmp_path, self.data_path)
+    self.data_file = open(self.data_path, 'a+b')
+    self.index = new_index
+    self.dirty = True
+    self.flush()
+
+  def flush(self):
+    if self.data_file is None or not self.dirty:
+      return
+    self.data_file.flush()
+    tmp_path = self.index_path + '.tmp'
+    try:
+      with open(tmp_path, 'wt') as f:
+        json.dump(self.index, f)
+      replace_file(tmp_path, self.index_path)
+      self.dirty = False
+    except (IOError, OSError):
+      pass
+
+  def close(self):
+    self.flush()
+    if self.data_map is not None:
+      self.data_map.close()
+      self.data_map = None
+    if self.data_file is not None:
+      self.data_file.close()
+      self.data_file = None
+
+class ImageLRU(object):
+  # In-memory cache of decoded images, bounded by the total size of their
+  # pixels. The least recently used images are dropped first.
+  def __init__(self, max_bytes=256*1024*1024):
+    self.max_bytes = max_bytes
+    self.images = collections.OrderedDict()
+    self.n_bytes = 0
+
+  def get_nbytes(self, img):
+    return img.size[0]*img.size[1]*len(img.getbands())
+
+  def __contains__(self, key):
+    return key in self.images
+
+  def get(self, key):
+    img = self.images.pop(key, None)
+    if img is not None:
+      self.images[key] = img
+    return img
+
+  def put(self, key, img):
+    old = self.images.pop(key, None)
+    if old is not None:
+      self.n_bytes -= self.get_nbytes(old)
+
+    nbytes = self.get_nbytes(img)
+    if nbytes > self.max_bytes:
+      return
+    self.images[key] = img
+    self.n_bytes += nbytes
+
+    while self.n_bytes > self.max_bytes:
+      _, img = self.images.popitem(last=False)
+      self.n_bytes -= self.get_nbytes(img)
+
+def read_image_info(fname, cached=None):
+  # size, modification time, dimensions and EXIF capture time (or None) of an
+  # image file; the header is only read if the file differs from `cached`
+  stat = os.stat(fname)
+  if (cached is not None and cached['size'] == stat.st_size and
+      cached['mtime'] == stat.st_mtime):
+    return cached
+
+  img = Image.open(fname)
+  date = None
+  try:
+    exif = img._getexif()
+    if exif is not None:
+      date = exif.get(36867)
+  except (AttributeError, KeyError, IndexError, SyntaxError, IOError):
+    pass
+
+  return {'path': fname, 'size': stat.st_size, 'mtime': stat.st_mtime,
+          'width': img.size[0], 'height': img.size[1], 'date': date}
+
+class MetadataIndex(object):
+  # SQLite table of image dimensions and capture times, keyed by absolute
+  # path and checked against the file size and modification time. Like the
+  # thumbnail cache, it is only used from the GUI thread.
+  def __init__(self, cache_dir=None, name='metadata'):
+    if cache_dir is None:
+      cache_dir = get_default_cache_dir()
+    self.db = None
+    try:
+      if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+      self.db = sqlite3.connect(os.path.join(cache_dir, name + '.sqlite'))
+      self.db.execute("CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY "
+                      "KEY, size INTEGER, mtime REAL, width INTEGER, "
+                      "height INTEGER, date TEXT)")
+    except (OSError, sqlite3.Error):
+      # index unusable; everything will be read from the files
+      self.db = None
+
+  def get(self, files):
+    # cached entries for the given files, as a dict keyed by file name;
+    # these still need to be checked against the files
+    if self.db is None:
+      return {}
+
+    paths = {os.path.abspath(_): _ for _ in files}
+    entries = {}
+    try:
+      for row in self.db.execute("SELECT path, size, mtime, width, height, "
+                                 "date FROM images"):
+        fname = paths.get(row[0])
+        if fname is not None:
+          entries[fname] = {'path': fname, 'size': row[1], 'mtime': row[2],
+                            'width': row[3], 'height': row[4],
+                            'date': row[5]}
+    except sqlite3.Error:
+      pass
+    return entries
+
+  def put(self, infos):
+    if self.db is None or len(infos) == 0:
+      return
+    try:
+      self.db.executemany("INSERT OR REPLACE INTO images VALUES "
+                          "(?, ?, ?, ?, ?, ?)",
+                          [(os.path.abspath(_['path']), _['size'],
+                            _['mtime'], _['width'], _['height'], _['date'])
+                           for _ in infos])
+      self.db.commit()
+    except sqlite3.Error:
+      pass
+
+  def close(self):
+    if self.db is not None:
+      self.db.close()
+      self.db = None
+
+# Image pyramids for zooming: level 0 is the full-resolution image, and each
+# further level halves the one before, down to a single tile. Every level is
+# an uncompressed .npy file in a folder named after the image file's path,
+# size and modification time, so that tiles can be cut out of memory-mapped
+# levels without decoding the image again.
+PYRAMID_TILE = 256
+
+def get_pyramid_levels(size, tile_size=PYRAMID_TILE):
+  # sizes of all the levels for an image of the given size
+  levels = [tuple(size)]
+  while max(levels[-1]) > tile_size:
+    levels.append((max(levels[-1][0]//2, 1), max(levels[-1][1]//2, 1)))
+  return levels
+
+def get_pyramid_path(pyramid_dir, fname):
+  stat = os.stat(fname)
+  key = "{}|{}|{!r}".format(os.path.abspath(fname), stat.st_size,
+                            stat.st_mtime)
+  return os.path.join(pyramid_dir, hashlib.sha1(key).hexdigest())
+
+def build_pyramid(fname, path, tile_size=PYRAMID_TILE, stale_after=600):
+  # generator, yielding between steps; only one process builds a given
+  # pyramid, the others wait for it to appear
+  tmp_path = path + '.tmp'
+  while not os.path.isdir(path):
+    try:
+      os.makedirs(tmp_path)
+    except OSError:
+      # someone else is building it; take over if they seem to have died
+      try:
+        if time.time() - os.path.getmtime(tmp_path) > stale_after:
+          shutil.rmtree(tmp_path, ignore_errors=True)
+      except OSError:
+        pass
+      yield None
+      time.sleep(0.05)
+      continue
+
+    try:
+      img = Image.open(fname)
+      img.load()
+      if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+      yield None
+
+      for level, size in enumerate(get_pyramid_levels(img.size, tile_size)):
+        if img.size != size:
+          img = img.resize(size, resample=Image.BOX)
+        np.save(os.path.join(tmp_path, 'level{}.npy'.format(level)),
+                np.asarray(img))
+        yield None
+
+      try:
+        os.rename(tmp_path, path)
+      except OSError:
+        # lost a race after taking over a stale build
+        if not os.path.isdir(path):
+          raise
+    finally:
+      shutil.rmtree(tmp_path, ignore_errors=True)
+
+  # mark as recently used, for pruning
+  try:
+    os.utime(path, None)
+  except OSError:
+    pass
+
+def read_pyramid_level(path, level):
+  return np.load(os.path.join(path, 'level{}.npy'.format(level)),
+                 mmap_mode='r')
+
+def prune_pyramids(pyramid_dir, max_bytes):
+  # remove the least recently used pyramids until the rest fit in max_bytes
+  try:
+    names = [_ for _ in os.listdir(pyramid_dir) if not _.endswith('.tmp')]
+  except OSError:
+    return
+
+  entries = []
+  for name in names:
+    path = os.path.join(pyramid_dir, name)
+    try:
+      nbytes = sum(os.path.getsize(os.path.join(path, _))
+                   for _ in os.listdir(path))
+      entries.append((os.path.getmtime(path), nbytes, path))
+    except OSError:
+      pass
+
+  total = sum(_[1] for _ in entries)
+  for _, nbytes, path in sorted(entries):
+    if total <= max_bytes:
+      break
+    shutil.rmtree(path, ignore_errors=True)
+    total -= nbytes
@@ -0,0 +1,469 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import ast
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+# Anchor files are tab-separated text: a header with the anchor names, then
+# one row per image with either "(x, y)" or "None" in each column.
+# Transformation files have an optional "# pad = (...), dims = (...)" comment,
+# a header with the parameter names, then one row of numbers per image.
+# Transformations can also be stored as one 3x3 matrix per image, in a
+# binary .npz file together with the model that produced them.
+#
+# Both are parsed here in a vectorized way into NumPy arrays (missing anchors
+# become NaN), and a binary .npz sidecar is kept next to each text file so
+# that later loads can skip parsing entirely. The sidecar records the size
+# and modification time of the text file it was made from, and is ignored
+# once the text file changes.
+
+# placeholder for missing anchors while formatting integer positions
+MISSING = -987654321
+
+def replace_file(src, dst):
+  # os.rename does not overwrite existing files on Windows
+  try:
+    os.rename(src, dst)
+  except OSError:
+    os.remove(dst)
+    os.rename(src, dst)
+
+# bumped whenever the layout of the sidecars changes, so that older ones are
+# rebuilt instead of misread
+SIDECAR_VERSION = 2
+
+def get_sidecar_name(fname):
+  return fname + '.npz'
+
+def get_file_id(fname):
+  stat = os.stat(fname)
+  return np.asarray([stat.st_size, stat.st_mtime])
+
+def read_sidecar(fname):
+  # returns the sidecar contents as a dict, or None if it is missing or stale
+  try:
+    file_id = get_file_id(fname)
+    with np.load(get_sidecar_name(fname)) as data:
+      if (data['version'] != SIDECAR_VERSION or
+          not np.array_equal(data['file_id'], file_id)):
+        return None
+      return {key: data[key] for key in data.files}
+  except (IOError, OSError, KeyError, ValueError):
+    return None
+
+def write_sidecar(fname, **arrays):
+  # failing to write the sidecar is not an error, it only makes the next load
+  # slower
+  try:
+    with open(get_sidecar_name(fname), 'wb') as f:
+      np.savez(f, file_id=get_file_id(fname), version=SIDECAR_VERSION,
+               **arrays)
+  except (IOError, OSError):
+    pass
+
+def split_header(fname):
+  with open(fname, 'rt') as f:
+    text = f.read()
+
+  lines = text.split('\n', 1)
+  header = [_.strip() for _ in lines[0].strip().split('\t')]
+  body = lines[1] if len(lines) > 1 else ''
+  return (header, body)
+
+def parse_anchor_text(fname):
+  header, body = split_header(fname)
+  n_rows = len([_ for _ in body.split('\n') if len(_.strip()) > 0])
+
+  # turn "(x, y)" into "x y" and "None" into "nan nan", then parse everything
+  # in one go
+  for c in '(),':
+    body = body.replace(c, ' ')
+  body = body.replace('None', 'nan nan')
+  values = np.fromstring(body, dtype=float, sep=' ')
+
+  return (header, values.reshape(n_rows, len(header), 2))
+
+def read_anchor_array(fname):
+  # returns the anchor names and an (n_images, n_anchors, 2) array of
+  # positions, with NaN for missing anchors; (None, None) if there is no file
+  try:
+    data = read_sidecar(fname)
+    if data is not None:
+      return (data['names'].tolist(), data['anchors'])
+
+    anchor_names, anchors = parse_anchor_text(fname)
+  except IOError:
+    return (None, None)
+
+  write_sidecar(fname, names=np.asarray(anchor_names), anchors=anchors)
+  return (anchor_names, anchors)
+
+def write_anchor_array(fname, anchor_names, anchors):
+  anchors = np.asarray(anchors, dtype=float)
+  n_images, n_anchors = anchors.shape[:2]
+  valid = np.isfinite(anchors).all(axis=-1)
+
+  # format the whole table with a single string operation; integer positions
+  # (as clicked in the GUI) are written as integers
+  if np.all(anchors[valid] == np.round(anchors[valid])):
+    cell = "({:d}, {:d})"
+    values = np.where(valid[..., None], anchors, MISSING).astype(int)
+    missing = cell.format(MISSING, MISSING)
+  else:
+    cell = "({!r}, {!r})"
+    values = np.where(valid[..., None], anchors, np.nan)
+    missing = cell.format(np.nan, np.nan)
+  row = '\t'.join([cell]*n_anchors) + '\n'
+  body = (row*n_images).format(*values.ravel().tolist())
+
+  # write to a temporary file first, so that a crash never leaves a
+  # half-written table behind
+  tmp_name = fname + '.tmp'
+  with open(tmp_name, 'wt') as f:
+    f.write('\t'.join(anchor_names) + '\n')
+    f.write(body.replace(missing, 'None'))
+  replace_file(tmp_name, fname)
+
+  write_sidecar(fname, names=np.asarray(anchor_names), anchors=anchors)
+
+def anchors_to_lists(anchors):
+  # per-image lists of (x, y) tuples, with None for missing anchors, and
+  # integer coordinates kept as integers
+  convert = lambda v: int(v) if v == int(v) else float(v)
+  return [[(convert(anchor[0]), convert(anchor[1]))
+           if np.isfinite(anchor).all() else None
+           for anchor in img_anchors] for img_anchors in anchors]
+
+def anchors_from_lists(all_anchors):
+  n_anchors = len(all_anchors[0]) if len(all_anchors) > 0 else 0
+  return np.asarray([[(np.nan, np.nan) if _ is None else _
+                      for _ in img_anchors] for img_anchors in all_anchors],
+                    dtype=float).reshape(len(all_anchors), n_anchors, 2)
+
+def read_anchors(fname):
+  anchor_names, anchors = read_anchor_array(fname)
+  if anchors is None:
+    return (None, None)
+
+  return (anchor_names, anchors_to_lists(anchors))
+
+def write_anchors(fname, anchor_names, all_anchors):
+  write_anchor_array(fname, anchor_names, anchors_from_lists(all_anchors))
+
+def parse_key_tuple(s, key):
+  idx1 = s.find(key)
+  if idx1 >= 0:
+    expr = s[idx1+len(key):].strip()
+    if expr[0] == '=':
+      expr = expr[1:].strip()
+      if expr[0] == '(':
+        idx1e = expr.find(')')
+        if idx1e >= 0:
+          expr = expr[:idx1e+1]
+          return ast.literal_eval(expr)
+
+  return None
+
+def parse_trafo_text(fname):
+  with open(fname, 'rt') as f:
+    lines = [_.strip() for _ in f.read().split('\n')]
+
+  comments = [_ for _ in lines if _.startswith('#')]
+  lines = [_ for _ in lines if len(_) > 0 and not _.startswith('#')]
+
+  pad = None
+  dims = None
+  if len(comments) > 0:
+    pad_value = parse_key_tuple(comments[0], "pad")
+    dims_value = parse_key_tuple(comments[0], "dims")
+
+    if pad_value is not None and len(pad_value) == 2:
+      pad = pad_value
+    if dims_value is not None and len(dims_value) == 2:
+      dims = dims_value
+
+  param_names = [_.strip() for _ in lines[0].split('\t')]
+  values = np.fromstring('\n'.join(lines[1:]), dtype=float, sep=' ')
+  return (param_names, values.reshape(-1, len(param_names)), pad, dims)
+
+def read_trafo_array(fname):
+  # returns the parameter names, an (n_images, n_params) array of values,
+  # and the pad and dims given in the first comment (None if not given)
+  data = read_sidecar(fname)
+  if data is not None:
+    # a missing pad and dims are stored as empty arrays
+    pad = tuple(data['pad'].tolist()) if data['pad'].size > 0 else None
+    dims = tuple(data['dims'].tolist()) if data['dims'].size > 0 else None
+    return (data['names'].tolist(), data['values'], pad, dims)
+
+  param_names, values, pad, dims = parse_trafo_text(fname)
+  write_trafo_sidecar_(fname, param_names, values, pad, dims)
+  return (param_names, values, pad, dims)
+
+def write_trafo_sidecar_(fname, param_names, values, pad, dims):
+  has_pad = pad is not None and dims is not None
+  write_sidecar(fname, names=np.asarray(param_names),
+                values=np.asarray(values, dtype=float),
+                pad=np.asarray(pad if has_pad else ()),
+                dims=np.asarray(dims if has_pad else ()))
+
+def write_trafo_array(fname, param_names, values, pad=None, dims=None):
+  with open(fname, 'wt') as f:
+    if pad is not None and dims is not None:
+      f.write('# pad = {}, dims = {}\n'.format(tuple(pad), tuple(dims)))
+    f.write('\t'.join(param_names) + '\n')
+    for row in values:
+      f.write('\t'.join(str(_) for _ in row) + '\n')
+
+  write_trafo_sidecar_(fname, param_names, values, pad, dims)
+
+# `imoptim -p` writes alpha, x, y, theta instead of a, b, dx, dy; these
+# describe the same transformation relative to an image of size `dims`
+# padded by `pad` on the top left
+def get_processed_params(params, pad, dims):
+  # (n_images, 4) arrays of a, b, dx, dy to alpha, x, y, theta
+  a, b, dx, dy = np.asarray(params, dtype=float).T
+  pad_x, pad_y = [float(_) for _ in pad]
+  w2, h2 = [_/2.0 for _ in dims]
+  alpha = np.sqrt(a**2 + b**2)
+  x = ((a*(dx + pad_x*(1-a)) - b*(dy + pad_y + pad_x*b))/alpha +
+       w2*(1 - a/alpha) + h2*b/alpha)
+  y = ((a*(dy + pad_y*(1-a)) + b*(dx + pad_x - pad_y*b))/alpha +
+       h2*(1 - a/alpha) - w2*b/alpha)
+  return np.stack([alpha, x, y, np.arctan2(b, a)], axis=-1)
+
+def get_params_from_processed(processed, pad, dims):
+  # the inverse of get_processed_params
+  alpha, x, y, theta = np.asarray(processed, dtype=float).T
+  pad_x, pad_y = [float(_) for _ in pad]
+  w2, h2 = [_/2.0 for _ in dims]
+  c = np.cos(theta)
+  s = np.sin(theta)
+  a = alpha*c
+  b = alpha*s
+  # x and y are a rotation of dx and dy, plus terms that do not depend on
+  # them
+  x0 = c*pad_x*(1 - a) - s*(pad_y + pad_x*b) + w2*(1 - c) + h2*s
+  y0 = c*pad_y*(1 - a) + s*(pad_x - pad_y*b) + h2*(1 - c) - w2*s
+  dx = c*(x - x0) + s*(y - y0)
+  dy = -s*(x - x0) + c*(y - y0)
+  return np.stack([a, b, dx, dy], axis=-1)
+
+# models a matrix file can hold, from the most to the least constrained
+TRAFO_MODELS = ['similarity', 'affine', 'homography']
+
+def is_trafo_matrix_file(fname):
+  # matrix files are zip archives, unlike the text formats
+  with open(fname, 'rb') as f:
+    return f.read(4) == b'PK\x03\x04'
+
+def write_trafo_matrices(fname, matrices, model='similarity'):
+  # `matrices` has shape (n_images, 3, 3) and maps each image's coordinates
+  # to the reference image's
+  if model not in TRAFO_MODELS:
+    raise Exception("Unrecognized transformation model.")
+  tmp_fname = fname + '.tmp'
+  with open(tmp_fname, 'wb') as f:
+    np.savez(f, matrices=np.asarray(matrices, dtype=float),
+             model=np.asarray(model))
+  replace_file(tmp_fname, fname)
+
+def read_trafo_matrices(fname):
+  # returns the (n_images, 3, 3) matrices and the model
+  with np.load(fname) as data:
+    model = str(data['model'])
+    if model not in TRAFO_MODELS:
+      raise Exception("Unrecognized transformation model.")
+    return (data['matrices'], model)
+
+def read_trafos(fname):
+  # one dict per image, as used by imtransform; matrix files are read with
+  # read_trafo_matrices instead
+  param_names, values, pad, dims = read_trafo_array(fname)
+  trafos = []
+  for row in values:
+    trafo = {param: float(row[i]) for i, param in enumerate(param_names)}
+    trafo['pad'] = pad
+    trafo['dims'] = dims
+    trafos.append(trafo)
+
+  return trafos
+
+# Anchor edits are also appended, one JSON record per line, to journal files
+# named <anchors file>.journal.<n>. Each segment starts with the hash of the
+# anchor table it applies to, so that on startup exactly the segments that
+# are not yet part of the anchors file get replayed, whatever point a crash
+# happened at. Compaction starts a new segment, writes the full table in a
+# background thread and then deletes the older segments.
+JOURNAL_SUFFIX = '.journal.'
+
+def get_state_hash(anchor_names, anchors):
+  anchors = np.asarray(anchors, dtype='<f8')
+  anchors = np.where(np.isfinite(anchors), anchors, np.nan)
+  digest = hashlib.sha1(json.dumps(list(anchor_names)).encode('utf-8'))
+  digest.update(repr(anchors.shape))
+  digest.update(anchors.tobytes())
+  return digest.hexdigest()
+
+def get_journal_segments(fname):
+  # (number, path) for every journal segment, in order
+  folder = os.path.dirname(os.path.abspath(fname))
+  prefix = os.path.basename(fname) + JOURNAL_SUFFIX
+  segments = []
+  for name in os.listdir(folder):
+    if name.startswith(prefix) and name[len(prefix):].isdigit():
+      segments.append((int(name[len(prefix):]), os.path.join(folder, name)))
+  return sorted(segments)
+
+def read_journal(path):
+  # header and records of a journal segment; a torn last line is ignored
+  header = None
+  records = []
+  with open(path, 'rt') as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        break
+      if header is None:
+        header = record
+      else:
+        records.append(record)
+  return (header, records)
+
+def apply_journal_record(anchor_names, all_anchors, record):
+  # all_anchors holds one list of anchors per image
+  op = record.get('op')
+  if op == 'set':
+    i, k = record['i'], record['k']
+    if i < len(all_anchors) and k < len(anchor_names):
+      pos = record['pos']
+      all_anchors[i][k] = tuple(pos) if pos is not None else None
+  elif op == 'add':
+    anchor_names.append(record['name'])
+    for img_anchors in all_anchors:
+      img_anchors.append(None)
+  elif op == 'remove':
+    k = record['k']
+    if k < len(anchor_names):
+      anchor_names.pop(k)
+      for img_anchors in all_anchors:
+        img_anchors.pop(k)
+  elif op == 'rename':
+    if record['k'] < len(anchor_names):
+      anchor_names[record['k']] = record['name']
+
+class AnchorJournal(object):
+  def __init__(self, fname, compact_every=1000):
+    self.fname = fname
+    self.compact_every = compact_every
+    self.file = None
+    self.segment = 0
+    self.n_records = 0
+    self.thread = None
+
+  def load(self, n_images):
+    # anchors file plus whatever the journal has on top of it; returns the
+    # anchor names, per-image lists of anchors, and whether any journal
+    # records were used
+    anchor_names, all_anchors = read_anchors(self.fname)
+    if anchor_names is None:
+      anchor_names = []
+      all_anchors = []
+    all_anchors = [list(_) for _ in all_anchors[:n_images]]
+    while len(all_anchors) < n_images:
+      all_anchors.append([None for _ in anchor_names])
+
+    replayed = False
+    matched = True
+    for n, path in get_journal_segments(self.fname):
+      self.segment = max(self.segment, n)
+      try:
+        header, records = read_journal(path)
+      except IOError:
+        continue
+
+      # segments that do not match are already part of the anchors file
+      state = get_state_hash(anchor_names, anchors_from_lists(all_anchors))
+      matched = header is not None and header.get('base') == state
+      if matched:
+        for record in records:
+          apply_journal_record(anchor_names, all_anchors, record)
+        replayed = replayed or len(records) > 0
+
+    if not matched:
+      # the latest segment should always apply; if it does not, the anchors
+      # file was changed by hand, and the journal is kept aside
+      print("Anchor journal for {} does not match it; moved to {}.".format(
+          self.fname, path + '.stale'))
+      replace_file(path, path + '.stale')
+
+    return (anchor_names, all_anchors, replayed)
+
+  def start_segment_(self, anchor_names, anchors):
+    if self.file is not None:
+      self.file.close()
+    self.segment += 1
+    self.file = open(self.fname + JOURNAL_SUFFIX + str(self.segment), 'wt')
+    self.n_records = 0
+    self.write_({'op': 'begin', 'base': get_state_hash(anchor_names,
+                                                        anchors)})
+
+  def begin(self, anchor_names, all_anchors):
+    # start journaling on top of the given state, which must be what load()
+    # returned
+    self.start_segment_(anchor_names, anchors_from_lists(all_anchors))
+
+  def write_(self, record):
+    # flushed to the OS right away, so that the record survives a crash of
+    # the program
+    self.file.write(json.dumps(record) + '\n')
+    self.file.flush()
+
+  def record(self, **record):
+    self.write_(record)
+    self.n_records += 1
+
+  def needs_compaction(self):
+    return (self.n_records >= self.compact_every and
+            (self.thread is None or not self.thread.is_alive()))
+
+  def compact(self, anchor_names, all_anchors, wait=False):
+    # write the full table in the background and drop the journal segments
+    # it covers; returns False if a compaction is already running
+    if self.thread is not None and self.thread.is_alive():
+      if not wait:
+        return False
+      self.thread.join()
+
+    anchor_names = list(anchor_names)
+    anchors = anchors_from_lists(all_anchors)
+    self.start_segment_(anchor_names, anchors)
+    self.thread = threading.Thread(target=self.write_snapshot_,
+                                   args=(anchor_names, anchors, self.segment))
+    self.thread.start()
+    if wait:
+      self.thread.join()
+    return True
+
+  def write_snapshot_(self, anchor_names, anchors, segment):
+    write_anchor_array(self.fname, anchor_names, anchors)
+    for n, path in get_journal_segments(self.fname):
+      if n < segment:
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+
+  def close(self):
+    if self.thread is not None:
+      self.thread.join()
+    if self.file is not None:
+      self.file.close()
+      self.file = None
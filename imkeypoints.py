@@ -0,0 +1,277 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import argparse
+import hashlib
+import os
+import sys
+
+from multiprocessing import Pool
+
+import numpy as np
+import scipy.ndimage
+from PIL import Image
+
+from imcache import get_default_cache_dir
+from imio import replace_file, write_anchor_array
+from imoptim import get_robust_trafos
+
+# Candidate anchors from detected keypoints. Harris corners are found on a
+# small pyramid of each image and described by normalized, blurred patches.
+# Every frame's keypoints are matched to the reference frame's by mutual
+# nearest neighbors; matches that do not agree with a similarity transform
+# are dropped, and reference keypoints that were found in enough frames
+# become candidate anchors. Keypoints are cached per file, so that only new
+# or changed images are ever analyzed again.
+
+# settings that affect the cached keypoints; changing them invalidates the
+# cache
+KEYPOINT_SIZE = 1024
+KEYPOINT_LEVELS = 2
+MAX_KEYPOINTS = 500
+DESCRIPTOR_GRID = 8
+DESCRIPTOR_STEP = 2
+
+def parse_command_line():
+  parser = argparse.ArgumentParser(
+    description="Suggest anchors from keypoints matched across an image set.",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('files', type=str, nargs='+',
+                      help="a file in the image set")
+  parser.add_argument('-o', '--output', default='img_anchors_suggested.txt',
+                      help="where to store the candidate anchors")
+  parser.add_argument('-r', '--reference', type=int, default=0,
+                      help="index of the image whose keypoints are matched "
+                          +"to all others")
+  parser.add_argument('-n', '--count', type=int, default=8,
+                      help="maximum number of candidate anchors")
+  parser.add_argument('--min-frames', type=float, default=0.5,
+                      help="fraction of the frames a keypoint must be found "
+                          +"in to become a candidate")
+  parser.add_argument('--cache-dir', default=get_default_cache_dir(),
+                      help="folder for the persistent keypoint cache")
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help="number of images to analyze in parallel")
+
+  args = parser.parse_args()
+
+  return args
+
+def detect_corners(gray, max_points=MAX_KEYPOINTS, sigma=1.5, k=0.05,
+                   radius=4, border=None):
+  # strongest local maxima of the Harris response, as (x, y) positions and
+  # responses; points closer to the edge than `border` are left out, so
+  # that their descriptors fit in the image
+  if border is None:
+    border = DESCRIPTOR_GRID*DESCRIPTOR_STEP
+  ix = scipy.ndimage.sobel(gray, axis=1)
+  iy = scipy.ndimage.sobel(gray, axis=0)
+  sxx = scipy.ndimage.gaussian_filter(ix*ix, sigma)
+  syy = scipy.ndimage.gaussian_filter(iy*iy, sigma)
+  sxy = scipy.ndimage.gaussian_filter(ix*iy, sigma)
+  response = sxx*syy - sxy**2 - k*(sxx + syy)**2
+
+  peaks = response == scipy.ndimage.maximum_filter(response, 2*radius + 1)
+  peaks &= response > 0.01*response.max()
+  peaks[:border] = False
+  peaks[-border:] = False
+  peaks[:, :border] = False
+  peaks[:, -border:] = False
+
+  y, x = np.nonzero(peaks)
+  values = response[y, x]
+  order = np.argsort(-values)[:max_points]
+  return (np.stack([x[order], y[order]], axis=-1).astype(float),
+          values[order])
+
+def get_descriptors(gray, points):
+  # blurred patches around the points, sampled on a coarse grid, with zero
+  # mean and unit norm
+  blurred = scipy.ndimage.gaussian_filter(gray, DESCRIPTOR_STEP)
+  offsets = (np.arange(DESCRIPTOR_GRID) - (DESCRIPTOR_GRID - 1)/2.0)*\
+      DESCRIPTOR_STEP
+  gx, gy = [_.ravel() for _ in np.meshgrid(offsets, offsets)]
+  x = points[:, 0, None] + gx
+  y = points[:, 1, None] + gy
+  patches = scipy.ndimage.map_coordinates(blurred, [y.ravel(), x.ravel()],
+                                          order=1, mode='nearest')
+  patches = patches.reshape(len(points), -1)
+  patches -= patches.mean(axis=-1, keepdims=True)
+  patches /= np.maximum(np.sqrt((patches**2).sum(axis=-1, keepdims=True)),
+                        1e-6)
+  return patches.astype(np.float32)
+
+def detect_keypoints(fname):
+  # keypoints of every level of a pyramid made from one draft-mode decode,
+  # with positions in full-resolution pixels; `scale` is that of the finest
+  # level
+  img = Image.open(fname)
+  full_size = img.size
+  scale = min(float(KEYPOINT_SIZE)/max(full_size), 1.0)
+  img.draft('L', (int(full_size[0]*scale), int(full_size[1]*scale)))
+  img = img.convert('L')
+
+  points = []
+  descriptors = []
+  responses = []
+  for level in range(KEYPOINT_LEVELS):
+    size = (max(int(round(full_size[0]*scale/2**level)), 1),
+            max(int(round(full_size[1]*scale/2**level)), 1))
+    gray = np.asarray(img.resize(size, resample=Image.BOX), dtype=np.float32)
+    level_points, level_responses = detect_corners(gray)
+    descriptors.append(get_descriptors(gray, level_points))
+    responses.append(level_responses)
+
+    level_scale = np.asarray([float(size[0])/full_size[0],
+                              float(size[1])/full_size[1]])
+    points.append((level_points + 0.5)/level_scale - 0.5)
+
+  return {'points': np.concatenate(points), 'responses':
+          np.concatenate(responses), 'descriptors':
+          np.concatenate(descriptors), 'size': np.asarray(full_size),
+          'scale': scale}
+
+def get_keypoint_path(keypoint_dir, fname):
+  stat = os.stat(fname)
+  key = "{}|{}|{!r}|{}|{}|{}|{}|{}".format(os.path.abspath(fname),
+      stat.st_size, stat.st_mtime, KEYPOINT_SIZE, KEYPOINT_LEVELS,
+      MAX_KEYPOINTS, DESCRIPTOR_GRID, DESCRIPTOR_STEP)
+  return os.path.join(keypoint_dir, hashlib.sha1(key).hexdigest() + '.npz')
+
+def load_keypoints(fname, keypoint_dir):
+  # keypoints from the cache, or detected and then cached
+  path = get_keypoint_path(keypoint_dir, fname)
+  try:
+    with np.load(path) as data:
+      return {_: data[_] for _ in data.files}
+  except (IOError, OSError, ValueError, KeyError):
+    pass
+
+  keypoints = detect_keypoints(fname)
+  try:
+    if not os.path.isdir(keypoint_dir):
+      os.makedirs(keypoint_dir)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      np.savez(f, **keypoints)
+    replace_file(tmp_path, path)
+  except (IOError, OSError):
+    # cache unusable; keypoints will be detected again next time
+    pass
+  return keypoints
+
+def load_keypoints_job(job):
+  # runs in a worker process; errors are passed back instead of raised
+  fname, keypoint_dir = job
+  try:
+    return (load_keypoints(fname, keypoint_dir), None)
+  except Exception as e:
+    return (None, "{}: {}".format(type(e).__name__, e))
+
+def match_descriptors(desc1, desc2, ratio=0.8):
+  # index pairs of mutual nearest neighbors that are also clearly closer
+  # than the second nearest neighbor
+  if len(desc1) < 2 or len(desc2) < 2:
+    return np.zeros((0, 2), dtype=int)
+
+  # descriptors have unit norm, so distances follow from dot products
+  dist = np.maximum(2 - 2*np.dot(desc1, desc2.T), 0)
+  best2 = dist.argmin(axis=1)
+  best1 = dist.argmin(axis=0)
+  mutual = best1[best2] == np.arange(len(desc1))
+
+  two = np.partition(dist, 1, axis=1)[:, :2]
+  distinct = np.sqrt(two[:, 0]) < ratio*np.sqrt(two[:, 1])
+
+  idx1 = np.flatnonzero(mutual & distinct)
+  return np.stack([idx1, best2[idx1]], axis=-1)
+
+def get_consistent_matches(points, ref_points, tolerance):
+  # mask of the matches that agree with a single similarity transform
+  if len(points) < 2:
+    return np.zeros(len(points), dtype=bool)
+  return get_robust_trafos(points[None], ref_points, method='ransac',
+                           threshold=tolerance)[2][0]
+
+def suggest_anchors(all_keypoints, reference=0, count=8, min_frames=0.5,
+                    tolerance=4.0, exclude=None):
+  # candidate anchors in the layout of imio.read_anchor_array, with NaN
+  # where a candidate was not found; `tolerance` is in pixels at the
+  # resolution of the keypoints, and candidates closer than a tenth of the
+  # image diagonal to each other or to the reference positions in `exclude`
+  # are skipped
+  ref = all_keypoints[reference]
+  n_images = len(all_keypoints)
+  n_ref = len(ref['points'])
+  positions = np.full((n_images, n_ref, 2), np.nan)
+  positions[reference] = ref['points']
+
+  for i, keypoints in enumerate(all_keypoints):
+    if i == reference or keypoints is None:
+      continue
+    matches = match_descriptors(ref['descriptors'], keypoints['descriptors'])
+    points = keypoints['points'][matches[:, 1]]
+    ref_points = ref['points'][matches[:, 0]]
+    good = get_consistent_matches(points, ref_points,
+                                  tolerance/keypoints['scale'])
+    positions[i, matches[good, 0]] = points[good]
+
+  # the most widely found keypoints first, strongest first among equals
+  found = np.isfinite(positions[..., 0]).sum(axis=0) - 1
+  order = np.lexsort((-ref['responses'], -found))
+  min_found = max(min_frames*(n_images - 1), 1)
+
+  spacing = 0.1*np.sqrt((ref['size']**2).sum())
+  chosen = []
+  taken = [] if exclude is None else [_ for _ in exclude
+                                      if np.isfinite(_).all()]
+  for k in order:
+    if found[k] < min_found or len(chosen) >= count:
+      break
+    point = ref['points'][k]
+    if all(np.sqrt(((point - _)**2).sum()) >= spacing for _ in taken):
+      chosen.append(k)
+      taken.append(point)
+
+  return positions[:, chosen]
+
+def find_candidates(files, keypoint_dir, reference=0, count=8,
+                    min_frames=0.5, exclude=None, jobs=1):
+  # keypoints for every file, from the cache where possible, and the
+  # candidate anchors they give
+  job_list = [(_, keypoint_dir) for _ in files]
+  if jobs > 1:
+    pool = Pool(jobs)
+    try:
+      results = pool.map(load_keypoints_job, job_list)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    results = map(load_keypoints_job, job_list)
+
+  all_keypoints = []
+  for fname, (keypoints, error) in zip(files, results):
+    if error is not None:
+      print("Failed to find keypoints in {}: {}".format(fname, error),
+            file=sys.stderr)
+    all_keypoints.append(keypoints)
+  if all_keypoints[reference] is None:
+    return np.zeros((len(files), 0, 2))
+
+  return suggest_anchors(all_keypoints, reference=reference, count=count,
+                         min_frames=min_frames, exclude=exclude)
+
+if __name__ == "__main__":
+  args = parse_command_line()
+  files = list(args.files)
+  files.sort()
+
+  candidates = find_candidates(files, os.path.join(args.cache_dir,
+      'keypoints'), reference=args.reference, count=args.count,
+      min_frames=args.min_frames, jobs=args.jobs)
+  print("Found {} candidate anchors.".format(candidates.shape[1]))
+
+  names = ["auto #{}".format(_ + 1) for _ in range(candidates.shape[1])]
+  write_anchor_array(args.output, names, np.round(candidates, 2))
@@ -0,0 +1,252 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import ctypes
+import heapq
+import itertools
+import os
+
+from multiprocessing import Process, Pipe, cpu_count
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+from PIL import Image
+
+from imcache import build_pyramid, get_pyramid_path, prune_pyramids, \
+    read_pyramid_level
+from imkeypoints import load_keypoints
+
+# Background image loading for the GUI. A fixed set of worker processes is
+# started once and fed decode requests one at a time through a private pipe
+# each. Requests wait in a priority queue on the GUI side until a worker is
+# free, so the most urgent one is always the next to start. Pixels come back
+# through shared memory, one slot per worker.
+#
+# Stale requests are cancelled cooperatively: each priority level has a
+# counter in shared memory that the GUI bumps to cancel everything at that
+# level, and workers compare it to the value the request was made with
+# between decoding steps. Workers are never killed mid-request.
+
+# priority levels, most urgent first
+MAIN = 0
+VISIBLE = 1
+BACKGROUND = 2
+
+class SharedSlots(object):
+  # A block of shared memory split into fixed-size slots. Loader processes
+  # copy pixels into a slot and only send a small descriptor (index, slot,
+  # size, mode) through their pipe; the GUI then builds the image straight
+  # from the shared buffer instead of unpickling a copy of the pixels.
+  def __init__(self, n_slots, slot_size):
+    self.n_slots = n_slots
+    self.slot_size = slot_size
+    self.buffer = RawArray(ctypes.c_char, n_slots*slot_size)
+
+  def write(self, slot, img):
+    # returns a descriptor for the image, with the pixels inlined if they do
+    # not fit in a slot
+    data = img.tobytes()
+    desc = {'size': img.size, 'mode': img.mode}
+    if len(data) > self.slot_size:
+      desc['pixels'] = data
+    else:
+      ctypes.memmove(ctypes.addressof(self.buffer) + slot*self.slot_size,
+                     data, len(data))
+      desc['slot'] = slot
+      desc['nbytes'] = len(data)
+    return desc
+
+  def read(self, desc):
+    # the image may share memory with the slot, so it must not be used after
+    # the slot is handed back
+    if 'pixels' in desc:
+      return Image.frombytes(desc['mode'], desc['size'], desc['pixels'])
+
+    data = buffer(self.buffer, desc['slot']*self.slot_size, desc['nbytes'])
+    return Image.frombuffer(desc['mode'], desc['size'], data, 'raw',
+                            desc['mode'], 0, 1)
+
+def read_resized(f, size):
+  # generator, so that the caller can give up between steps
+  img0 = Image.open(f)
+  img0.draft(img0.mode, size)
+  yield None
+
+  img0.load()
+  yield None
+
+  yield img0.resize(size, resample=Image.LANCZOS)
+
+def ensure_pyramid(f, pyramid_dir, max_bytes=None):
+  # build the pyramid if needed; each new pyramid is followed by pruning,
+  # so that the cache stays within `max_bytes` during a session, too
+  path = get_pyramid_path(pyramid_dir, f)
+  is_new = not os.path.isdir(path)
+  for _ in build_pyramid(f, path):
+    yield None
+  if is_new and max_bytes is not None:
+    prune_pyramids(pyramid_dir, max_bytes)
+
+def read_tile(f, size, tile, pyramid_dir, max_bytes=None):
+  # `tile` is (level, tx, ty, tile_size), where tile_size can be smaller
+  # than the PYRAMID_TILE the pyramid is built with, to cut smaller tiles
+  # when zoomed in; the pyramid is built first if needed
+  level, tx, ty, tile_size = tile
+  for _ in ensure_pyramid(f, pyramid_dir, max_bytes):
+    yield None
+  path = get_pyramid_path(pyramid_dir, f)
+
+  data = read_pyramid_level(path, level)
+  data = data[ty*tile_size:(ty+1)*tile_size, tx*tile_size:(tx+1)*tile_size]
+  img = Image.fromarray(np.ascontiguousarray(data))
+  yield None
+
+  # show single pixels when zoomed in past the full resolution
+  if size[0] > img.size[0]:
+    resample = Image.NEAREST
+  else:
+    resample = Image.BILINEAR
+  yield img.resize(size, resample=resample)
+
+def read_keypoints(f, keypoint_dir):
+  # the keypoints come from the cache where possible
+  yield None
+  yield load_keypoints(f, keypoint_dir)
+
+def run_loader(files, pipe_end, slots, slot, epochs, pyramid_dir=None,
+               pyramid_max_bytes=None):
+  # worker loop; a None request means quit
+  while True:
+    task = pipe_end.recv()
+    if task is None:
+      break
+
+    f = files[task['i']]
+    if task['kind'] == 'tile':
+      steps = read_tile(f, task['size'], task['data'], pyramid_dir,
+                        pyramid_max_bytes)
+    elif task['kind'] == 'keypoints':
+      steps = read_keypoints(f, task['data'])
+    else:
+      steps = read_resized(f, task['size'])
+
+    result = {'id': task['id']}
+    img = None
+    try:
+      for img in steps:
+        if epochs[task['level']] != task['epoch']:
+          img = None
+          break
+    except Exception as e:
+      img = None
+      result['error'] = "{}: {}".format(type(e).__name__, e)
+    # make sure partial pyramids are cleaned up right away
+    steps.close()
+
+    if isinstance(img, Image.Image):
+      result.update(slots.write(slot, img))
+    elif img is not None:
+      # anything else is small enough to go through the pipe
+      result['data'] = img
+    pipe_end.send(result)
+
+class LoaderPool(object):
+  def __init__(self, files, slot_size, n_workers=None, pyramid_dir=None,
+               pyramid_max_bytes=None):
+    self.files = files
+    self.slot_size = slot_size
+    self.pyramid_dir = pyramid_dir
+    self.pyramid_max_bytes = pyramid_max_bytes
+    self.n_workers = n_workers if n_workers is not None else cpu_count()
+
+    self.queue = []
+    self.counter = itertools.count()
+    self.running = [None for _ in range(self.n_workers)]
+    self.pipes = []
+    self.workers = []
+
+    self.epochs = RawArray('i', 3)
+    self.slots = SharedSlots(self.n_workers, slot_size)
+
+  def start(self):
+    for k in range(self.n_workers):
+      pipe = Pipe()
+      worker = Process(target=run_loader, args=(self.files, pipe[1],
+                       self.slots, k, self.epochs, self.pyramid_dir,
+                       self.pyramid_max_bytes))
+      worker.daemon = True
+      worker.start()
+      self.pipes.append(pipe)
+      self.workers.append(worker)
+
+  def connections(self):
+    # the GUI ends of the worker pipes, to be watched for results
+    return [_[0] for _ in self.pipes]
+
+  def submit(self, level, kind, i, size, data=None, rank=0):
+    # requests are ordered by level, then rank, then submission order
+    task = {'id': next(self.counter), 'level': level, 'kind': kind, 'i': i,
+            'size': tuple(size), 'data': data, 'epoch': self.epochs[level]}
+    heapq.heappush(self.queue, (level, rank, task['id'], task))
+    self.dispatch_()
+
+  def cancel(self, level, kind=None):
+    # drop every request at the given level, including the ones being
+    # decoded; with a `kind`, only drop the queued requests of that kind
+    if kind is None:
+      self.epochs[level] += 1
+    self.queue = [_ for _ in self.queue
+                  if _[0] != level or (kind is not None and
+                                       _[3]['kind'] != kind)]
+    heapq.heapify(self.queue)
+
+  def is_stale_(self, task):
+    return task['epoch'] != self.epochs[task['level']]
+
+  def dispatch_(self):
+    for k, task in enumerate(self.running):
+      if task is not None:
+        continue
+      while len(self.queue) > 0:
+        task = heapq.heappop(self.queue)[3]
+        if not self.is_stale_(task):
+          self.running[k] = task
+          self.pipes[k][0].send(task)
+          break
+
+  def receive(self, k):
+    # collect the result from worker `k`, if there is one, and hand it more
+    # work; returns a list of (request, image, error) for requests that are
+    # still current
+    results = []
+    conn = self.pipes[k][0]
+    while conn.poll():
+      result = conn.recv()
+      task = self.running[k]
+      self.running[k] = None
+      if task is None or task['id'] != result['id'] or self.is_stale_(task):
+        continue
+
+      if 'error' in result:
+        results.append((task, None, result['error']))
+      elif 'data' in result:
+        results.append((task, result['data'], None))
+      elif 'mode' in result:
+        # copy out of the slot before the worker gets its next request
+        results.append((task, self.slots.read(result).copy(), None))
+
+    self.dispatch_()
+    return results
+
+  def stop(self):
+    for pipe, worker in zip(self.pipes, self.workers):
+      if worker.is_alive():
+        try:
+          pipe[0].send(None)
+        except (IOError, OSError):
+          pass
+    for worker in self.workers:
+      worker.join(1)
+      if worker.is_alive():
+        worker.terminate()
@@ -1,35 +1,41 @@
 #! /usr/bin/env python2
 from __future__ import print_function
 
-import ast
+import argparse
+import math
 import sys
 
 import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
 
-def read_anchors(fname):
-  try:
-    with open(fname, 'rt') as f:
-      header = f.readline().strip()
-      anchor_names = [_.strip() for _ in header.split('\t')]
-      anchors = []
-      while True:
-        line = f.readline()
-        if len(line) == 0:
-          break
-
-        anchors_str = [_.strip() for _ in line.strip().split('\t')]
-        anchors_tup = [ast.literal_eval(_) for _ in anchors_str]
-        anchors.append(anchors_tup)
-  except IOError:
-    return (None, None)
-
-  return (anchor_names, anchors)
+from imio import read_anchor_array, write_trafo_matrices, get_processed_params
 
 def create_anchor_matrix(img_anchors):
-  # create matrix with anchors as columns
-  extend = lambda v: np.asarray(v + (1, ))
+  # create matrix with anchors as columns; missing anchors become NaN
+  extend = lambda v: np.asarray((np.nan, np.nan, 1) if v is None else
+                                v + (1, ), dtype=float)
   return np.asarray([extend(_) for _ in img_anchors]).T
 
+def read_weights(fname):
+  # per-anchor confidence weights, in the same layout as the anchor file
+  return np.loadtxt(fname, skiprows=1, ndmin=2)
+
+def write_weights(fname, anchor_names, weights):
+  with open(fname, 'wt') as f:
+    f.write('\t'.join(anchor_names) + '\n')
+    for row in weights:
+      f.write('\t'.join("{:g}".format(_) for _ in row) + '\n')
+
+def get_anchor_weights(all_img_anchors, target_anchors, weights=None):
+  # anchors missing in either the image or the target get zero weight
+  mask = (np.isfinite(all_img_anchors).all(axis=-1) &
+          np.isfinite(target_anchors).all(axis=-1))
+  if weights is None:
+    return mask.astype(float)
+  return np.where(mask, weights, 0.0)
+
 def get_best_trafo(img_anchors, target_anchors):
   proj = {'a': np.asarray([[1, 0, 0], [0, 1, 0], [0, 0, 0.0]]),
           'b': np.asarray([[0, 1, 0], [-1,0, 0], [0, 0, 0.0]]),
@@ -60,48 +66,657 @@ def get_best_trafo(img_anchors, target_anchors):
 
   return ({_: soln[i] for (i, _) in enumerate(params)}, m)
 
+trafo_params = ['a', 'b', 'dx', 'dy']
+
+def get_trafo_matrices(params):
+  # turn an (n, 4) array of a, b, dx, dy values into (n, 3, 3) matrices
+  a, b, dx, dy = params.T
+  matrices = np.zeros((len(params), 3, 3))
+  matrices[:, 0, 0] = a
+  matrices[:, 0, 1] = b
+  matrices[:, 0, 2] = dx
+  matrices[:, 1, 0] = -b
+  matrices[:, 1, 1] = a
+  matrices[:, 1, 2] = dy
+  matrices[:, 2, 2] = 1
+  return matrices
+
+def get_best_trafos(all_img_anchors, target_anchors, weights=None):
+  # batched version of get_best_trafo: all_img_anchors has shape
+  # (n_images, n_anchors, 2) and target_anchors has shape (n_anchors, 2);
+  # anchors that are NaN in either are ignored, and the others can be given
+  # per-image confidence weights of shape (n_images, n_anchors); returns the
+  # a, b, dx, dy values as an (n_images, 4) array, together with the
+  # corresponding (n_images, 3, 3) matrices
+  # images with fewer than two usable anchors get the identity transform
+  w = get_anchor_weights(all_img_anchors, target_anchors, weights)
+  sums = get_normal_terms(all_img_anchors, target_anchors, w).sum(axis=-2)
+  params = solve_normal_sums(sums)
+  return (params, get_trafo_matrices(params))
+
+# The normal equations for x' = a*x + b*y + dx, y' = -b*x + a*y + dy only
+# depend on these weighted sums over the anchors of an image: w*(x^2 + y^2),
+# w*x, w*y, w, w*(x*u + y*v), w*(y*u - x*v), w*u, w*v, and the number of
+# anchors used.
+n_normal_terms = 9
+
+def get_normal_terms(img_anchors, target_anchors, w):
+  # per-anchor contributions to the normal equations, shape (..., 9); the
+  # anchors are (..., 2) arrays, and entries with zero weight contribute
+  # nothing even if they are NaN
+  used = w > 0
+  x = np.where(used, img_anchors[..., 0], 0.0)
+  y = np.where(used, img_anchors[..., 1], 0.0)
+  u = np.where(used, target_anchors[..., 0], 0.0)
+  v = np.where(used, target_anchors[..., 1], 0.0)
+  w = np.where(used, w, 0.0)
+  return np.stack([w*(x**2 + y**2), w*x, w*y, w, w*(x*u + y*v),
+                   w*(y*u - x*v), w*u, w*v, used.astype(float)], axis=-1)
+
+def is_degenerate(sums):
+  # whether the summed terms, of shape (..., 9), do not determine a
+  # transformation: fewer than two anchors, or anchors all at (nearly) the
+  # same place; the determinant of the normal equations is the square of
+  # count*r2 - sx^2 - sy^2, the weighted spread of the points
+  sums = np.asarray(sums, dtype=float)
+  r2, sx, sy, count = np.rollaxis(sums, -1)[:4]
+  spread = count*r2 - sx**2 - sy**2
+  tiny = 1e-12*np.maximum(count*r2, 1e-300)
+  return (sums[..., -1] < 2) | ~(spread > tiny)
+
+def solve_normal_sums(sums):
+  # solve the normal equations given the summed terms, of shape (..., 9);
+  # returns a, b, dx, dy with shape (..., 4), and the identity where these
+  # are degenerate
+  sums = np.asarray(sums, dtype=float)
+  r2, sx, sy, count, su1, su2, su, sv, n_used = np.rollaxis(sums, -1)
+  zero = np.zeros_like(r2)
+  eqmat = np.stack([np.stack([r2,   zero, sx,    sy], axis=-1),
+                    np.stack([zero, r2,   sy,    -sx], axis=-1),
+                    np.stack([sx,   sy,   count, zero], axis=-1),
+                    np.stack([sy,   -sx,  zero,  count], axis=-1)], axis=-2)
+  rhs = np.stack([su1, su2, su, sv], axis=-1)
+
+  degenerate = is_degenerate(sums)
+  eqmat[degenerate] = np.eye(4)
+  rhs[degenerate] = (1, 0, 0, 0)
+
+  return np.linalg.solve(eqmat, rhs[..., None])[..., 0]
+
+class OnlineSolver(object):
+  # Keeps the normal equations of every image as running sums, so that
+  # moving a single anchor updates them in constant time (or in time
+  # proportional to the number of images, for anchors in the reference
+  # image), and the transformation of any one image can be found by solving
+  # a 4x4 system.
+  def __init__(self, n_images, reference=0):
+    self.n_images = n_images
+    self.reference = reference
+    self.reset(np.zeros((n_images, 0, 2)))
+
+  def reset(self, all_img_anchors):
+    # start over from an (n_images, n_anchors, 2) array, NaN where missing
+    self.anchors = np.array(all_img_anchors, dtype=float)
+    target = self.anchors[self.reference]
+    w = get_anchor_weights(self.anchors, target)
+    self.sums = get_normal_terms(self.anchors, target, w).sum(axis=-2)
+
+  def add_anchor(self):
+    self.anchors = np.concatenate([self.anchors,
+                                   np.nan*np.ones((self.n_images, 1, 2))],
+                                  axis=1)
+
+  def remove_anchor(self, k):
+    self.sums -= self.get_terms_(None, k)
+    self.anchors = np.delete(self.anchors, k, axis=1)
+
+  def get_terms_(self, i, k):
+    # contributions of anchor k to image i (or to all images, for i=None)
+    img = self.anchors[:, k] if i is None else self.anchors[i, k]
+    target = self.anchors[self.reference, k]
+    w = get_anchor_weights(img, target)
+    return get_normal_terms(img, target, w)
+
+  def set_anchor(self, i, k, pos):
+    # pos is an (x, y) pair, or None to remove the anchor
+    value = (np.nan, np.nan) if pos is None else pos
+    if i == self.reference:
+      # the target position changes for every image
+      self.sums -= self.get_terms_(None, k)
+      self.anchors[i, k] = value
+      self.sums += self.get_terms_(None, k)
+    else:
+      self.sums[i] -= self.get_terms_(i, k)
+      self.anchors[i, k] = value
+      self.sums[i] += self.get_terms_(i, k)
+
+  def get_trafo(self, i):
+    # a, b, dx, dy and the matrix for image i, or None if there are not
+    # enough distinct anchors to tell
+    if is_degenerate(self.sums[i]):
+      return None
+    params = solve_normal_sums(self.sums[i])
+    return (params, get_trafo_matrices(params[None])[0])
+
+  def get_residuals(self, i):
+    # distance, in the reference image, between where each anchor of image i
+    # ends up and where it should be; NaN where it cannot be computed
+    residuals = np.nan*np.ones(self.anchors.shape[1])
+    trafo = self.get_trafo(i)
+    if trafo is None:
+      return residuals
+
+    matrix = trafo[1]
+    mapped = np.dot(self.anchors[i], matrix[:2, :2].T) + matrix[:2, 2]
+    return np.sqrt(((mapped - self.anchors[self.reference])**2).sum(axis=-1))
+
+  def predict(self, i, k):
+    # expected position of anchor k in image i, from its position in the
+    # reference image; None if unknown
+    trafo = self.get_trafo(i)
+    target = self.anchors[self.reference, k]
+    if trafo is None or not np.isfinite(target).all():
+      return None
+
+    matrix = trafo[1]
+    # reference anchors all in one place map everything to a point
+    if not abs(np.linalg.det(matrix[:2, :2])) > 1e-12:
+      return None
+    x, y = np.linalg.solve(matrix[:2, :2], target - matrix[:2, 2])
+    return (x, y)
+
+def get_residuals(all_img_anchors, target_anchors, matrices):
+  # distances in the reference image between where each anchor ends up and
+  # where it should be, shape (n_images, n_anchors); NaN where missing
+  mapped = (np.einsum('nij,nkj->nki', matrices[:, :2, :2], all_img_anchors) +
+            matrices[:, None, :2, 2])
+  return np.sqrt(((mapped - target_anchors)**2).sum(axis=-1))
+
+def get_ransac_inliers(all_img_anchors, target_anchors, w, threshold,
+                       n_hypotheses=200, chunk_size=1024, seed=0):
+  # for every image, try `n_hypotheses` similarity transforms, each exactly
+  # fitting a random pair of its usable anchors, and keep the anchors that
+  # agree with the best one; hypotheses are scored by their truncated
+  # squared residuals (MSAC), all at once for a chunk of images
+  n_images, n_anchors = all_img_anchors.shape[:2]
+  usable = w > 0
+  inliers = np.zeros((n_images, n_anchors), dtype=bool)
+  rng = np.random.RandomState(seed)
+
+  # the similarity u + i*v = c*(x + i*y) + t has c = a - i*b and
+  # t = dx + i*dy
+  z = np.where(usable, all_img_anchors[..., 0] + 1j*all_img_anchors[..., 1],
+               0)
+  target = np.where(np.isfinite(target_anchors).all(axis=-1),
+                    target_anchors[:, 0] + 1j*target_anchors[:, 1], 0)
+
+  for start in range(0, n_images, chunk_size):
+    chunk = slice(start, start + chunk_size)
+    chunk_usable = usable[chunk]
+    n_usable = chunk_usable.sum(axis=-1)
+    n = len(n_usable)
+
+    # draw two different usable anchors per hypothesis; the usable ones come
+    # first in `order`
+    order = np.argsort(~chunk_usable, axis=-1, kind='mergesort')
+    n_choices = np.maximum(n_usable, 2)[:, None]
+    first = (rng.rand(n, n_hypotheses)*n_choices).astype(int)
+    second = (first + 1 + (rng.rand(n, n_hypotheses)*(n_choices - 1)).astype(
+        int)) % n_choices
+    rows = np.arange(n)[:, None]
+    first = order[rows, first]
+    second = order[rows, second]
+
+    zc = z[chunk]
+    z1 = zc[rows, first]
+    z2 = zc[rows, second]
+    w1 = target[first]
+    w2 = target[second]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      c = (w1 - w2)/(z1 - z2)
+      t = w1 - c*z1
+
+      # residuals of every anchor under every hypothesis
+      r2 = np.abs(c[..., None]*zc[:, None, :] + t[..., None] - target)**2
+    r2 = np.where(chunk_usable[:, None, :], np.minimum(r2, threshold**2), 0)
+    cost = r2.sum(axis=-1)
+    cost[~np.isfinite(cost)] = np.inf
+    best = cost.argmin(axis=-1)
+
+    residuals = np.abs(c[rows[:, 0], best][:, None]*zc +
+                       t[rows[:, 0], best][:, None] - target)
+    inliers[chunk] = chunk_usable & (residuals < threshold)
+    # images with just two usable anchors have nothing to vote with
+    inliers[chunk][n_usable <= 2] = chunk_usable[n_usable <= 2]
+
+  return inliers
+
+def get_robust_trafos(all_img_anchors, target_anchors, weights=None,
+                      method='ransac', threshold=20.0, n_iterations=10,
+                      **kwargs):
+  # like get_best_trafos, but a few misplaced anchors do not pull the
+  # transformations off; `threshold` is the residual, in reference image
+  # pixels, beyond which an anchor counts as an outlier. 'ransac' fits the
+  # inliers of the best two-anchor hypothesis; 'huber' and 'tukey' reweight
+  # the anchors iteratively, Tukey ignoring the outliers entirely. Returns
+  # the a, b, dx, dy values, the matrices, and a (n_images, n_anchors) mask
+  # of the inliers.
+  w = get_anchor_weights(all_img_anchors, target_anchors, weights)
+  usable = w > 0
+
+  def solve(anchor_w):
+    sums = get_normal_terms(all_img_anchors, target_anchors,
+                            anchor_w).sum(axis=-2)
+    params = solve_normal_sums(sums)
+    return (params, get_trafo_matrices(params))
+
+  if method == 'ransac':
+    inliers = get_ransac_inliers(all_img_anchors, target_anchors, w,
+                                 threshold, **kwargs)
+    # refit, and let anchors that the refit agrees with back in
+    for _ in range(2):
+      params, matrices = solve(w*inliers)
+      residuals = get_residuals(all_img_anchors, target_anchors, matrices)
+      inliers = usable & (np.where(usable, residuals, np.inf) < threshold)
+  elif method in ('huber', 'tukey'):
+    params, matrices = solve(w)
+    for k in range(n_iterations):
+      residuals = get_residuals(all_img_anchors, target_anchors, matrices)
+      residuals = np.where(usable, residuals, 0)
+      # Tukey's loss needs a good start, which Huber's provides
+      if method == 'huber' or k < n_iterations//2:
+        factor = np.where(residuals <= threshold, 1.0,
+                          threshold/np.maximum(residuals, 1e-12))
+      else:
+        # a small floor keeps images whose anchors are all outliers from
+        # being treated as having none
+        factor = np.maximum(np.where(residuals < threshold,
+                                     (1 - (residuals/threshold)**2)**2, 0),
+                            1e-6)
+      params, matrices = solve(w*factor)
+    residuals = get_residuals(all_img_anchors, target_anchors, matrices)
+    inliers = usable & (np.where(usable, residuals, np.inf) < threshold)
+  else:
+    raise Exception("Unrecognized robust estimation method.")
+
+  return (params, matrices, inliers)
+
+def get_affine_trafos(all_img_anchors, target_anchors, weights=None):
+  # least-squares affine transformations, in the layout of get_best_trafos;
+  # returns only the (n_images, 3, 3) matrices, with the identity for images
+  # with fewer than three usable anchors, or with all of them on a line
+  w = get_anchor_weights(all_img_anchors, target_anchors, weights)
+  used = w > 0
+  x = np.where(used, all_img_anchors[..., 0], 0.0)
+  y = np.where(used, all_img_anchors[..., 1], 0.0)
+  ones = used.astype(float)
+  design = np.stack([x, y, ones], axis=-1)
+  targets = np.where(used[..., None], target_anchors, 0.0)
+
+  eqmat = np.einsum('nk,nki,nkj->nij', w, design, design)
+  rhs = np.einsum('nk,nki,nkj->nij', w, design, targets)
+
+  degenerate = (used.sum(axis=-1) < 3) | (np.linalg.matrix_rank(eqmat) < 3)
+  eqmat[degenerate] = np.eye(3)
+  rhs[degenerate] = [[1, 0], [0, 1], [0, 0]]
+
+  matrices = np.tile(np.eye(3), (len(w), 1, 1))
+  matrices[:, :2, :] = np.swapaxes(np.linalg.solve(eqmat, rhs), -1, -2)
+  return matrices
+
+def get_normalization(points, used):
+  # matrices (..., 3, 3) moving the used points to have zero mean and an
+  # average distance of sqrt(2) from the origin, for each image
+  count = np.maximum(used.sum(axis=-1), 1)
+  points = np.where(used[..., None], points, 0.0)
+  center = points.sum(axis=-2)/count[..., None]
+  dist = np.sqrt(((points - center[..., None, :])**2).sum(axis=-1))
+  mean_dist = np.where(used, dist, 0).sum(axis=-1)/count
+  scale = np.sqrt(2)/np.maximum(mean_dist, 1e-12)
+
+  norm = np.zeros(center.shape[:-1] + (3, 3))
+  norm[..., 0, 0] = scale
+  norm[..., 1, 1] = scale
+  norm[..., :2, 2] = -scale[..., None]*center
+  norm[..., 2, 2] = 1
+  return norm
+
+def get_homography_trafos(all_img_anchors, target_anchors, weights=None):
+  # homographies by the normalized direct linear transform, in the layout
+  # of get_affine_trafos; images with fewer than four usable anchors get the
+  # identity
+  w = get_anchor_weights(all_img_anchors, target_anchors, weights)
+  used = w > 0
+  n_images, n_anchors = used.shape
+  targets = np.broadcast_to(target_anchors, all_img_anchors.shape)
+
+  # normalizing the points first keeps the linear system well conditioned
+  src_norm = get_normalization(all_img_anchors, used)
+  dst_norm = get_normalization(targets, used)
+  def apply(norm, points):
+    points = np.where(used[..., None], points, 0.0)
+    return (np.einsum('nij,nkj->nki', norm[:, :2, :2], points) +
+            norm[:, None, :2, 2])
+  x, y = np.rollaxis(apply(src_norm, all_img_anchors), -1)
+  u, v = np.rollaxis(apply(dst_norm, targets), -1)
+
+  # two equations per anchor, weighted; unused anchors give zero rows
+  zero = np.zeros_like(x)
+  one = np.ones_like(x)
+  rows = np.stack([
+      np.stack([-x, -y, -one, zero, zero, zero, u*x, u*y, u], axis=-1),
+      np.stack([zero, zero, zero, -x, -y, -one, v*x, v*y, v], axis=-1)],
+      axis=-2)
+  rows *= np.sqrt(np.where(used, w, 0))[..., None, None]
+  rows = rows.reshape(n_images, 2*n_anchors, 9)
+  # zero rows change nothing, and with at least 9 rows the reduced SVD has
+  # all the right singular vectors
+  if rows.shape[1] < 9:
+    rows = np.concatenate([rows, np.zeros((n_images, 9 - rows.shape[1], 9))],
+                          axis=1)
+
+  # the solution is the right singular vector with the smallest singular
+  # value
+  normalized = np.linalg.svd(rows, full_matrices=False)[2][:, -1]
+  normalized = normalized.reshape(n_images, 3, 3)
+  matrices = np.einsum('nij,njk,nkl->nil', np.linalg.inv(dst_norm),
+                       normalized, src_norm)
+
+  scale = matrices[:, 2, 2]
+  scale = np.where(np.abs(scale) > 1e-12, scale, 1.0)
+  matrices /= scale[:, None, None]
+
+  degenerate = (used.sum(axis=-1) < 4) | ~np.isfinite(matrices).all(
+      axis=(-2, -1))
+  matrices[degenerate] = np.eye(3)
+  return matrices
+
+# number of anchors each model needs to be determined
+model_min_anchors = {'similarity': 2, 'affine': 3, 'homography': 4}
+
+def get_model_trafos(all_img_anchors, target_anchors, weights=None,
+                     model='similarity'):
+  # (n_images, 3, 3) matrices of the given model
+  if model == 'similarity':
+    return get_best_trafos(all_img_anchors, target_anchors, weights)[1]
+  elif model == 'affine':
+    return get_affine_trafos(all_img_anchors, target_anchors, weights)
+  elif model == 'homography':
+    return get_homography_trafos(all_img_anchors, target_anchors, weights)
+  else:
+    raise Exception("Unrecognized transformation model.")
+
+def solve_block_normal(mat, rhs, n_blocks):
+  # solve the normal equations of `mat`, whose first 4*n_blocks unknowns only
+  # couple to each other within blocks of four (one block per image), by
+  # eliminating those blocks first; what is left is a small sparse system
+  # for the remaining (anchor) unknowns, so the cost grows linearly with the
+  # number of images
+  n_frame = 4*n_blocks
+  mat = mat.tocsc()
+  mat_f = mat[:, :n_frame]
+  mat_a = mat[:, n_frame:]
+
+  normal_ff = (mat_f.T*mat_f).tocsr()
+  idx = 4*np.arange(n_blocks)[:, None, None]
+  rows = (idx + np.arange(4)[None, :, None] + 0*np.arange(4)).ravel()
+  cols = (idx + 0*np.arange(4)[:, None] + np.arange(4)[None, None, :]).ravel()
+  blocks = np.asarray(normal_ff[rows, cols]).reshape(n_blocks, 4, 4)
+  inv_ff = scipy.sparse.bsr_matrix((np.linalg.inv(blocks),
+                                    np.arange(n_blocks),
+                                    np.arange(n_blocks + 1)),
+                                   shape=(n_frame, n_frame)).tocsr()
+
+  normal_fa = (mat_f.T*mat_a).tocsr()
+  normal_aa = (mat_a.T*mat_a).tocsr()
+  rhs_f = mat_f.T*rhs
+  rhs_a = mat_a.T*rhs
+
+  tmp = (normal_fa.T*inv_ff).tocsr()
+  schur = (normal_aa - tmp*normal_fa).tocsc()
+  soln_a = scipy.sparse.linalg.spsolve(schur, rhs_a - tmp*rhs_f)
+  soln_f = inv_ff*(rhs_f - normal_fa*soln_a)
+
+  return np.concatenate([soln_f, np.atleast_1d(soln_a)])
+
+def get_global_trafos(all_img_anchors, weights=None, reference=0,
+                      solver='direct', regularization=1e-6):
+  # align all images jointly: each image's transformation and each anchor's
+  # position in the reference frame are unknowns of one sparse least-squares
+  # problem, so anchors that are only visible in part of the sequence, and
+  # not in the reference image, still contribute; the reference image's
+  # transformation is fixed to the identity
+  n_images = all_img_anchors.shape[0]
+  valid = np.isfinite(all_img_anchors).all(axis=-1)
+  if weights is not None:
+    valid &= weights > 0
+  img_idx, anchor_idx = np.nonzero(valid)
+  return get_global_trafos_sparse(n_images, img_idx, anchor_idx,
+      all_img_anchors[valid], None if weights is None else weights[valid],
+      reference=reference, solver=solver, regularization=regularization)
+
+def get_global_trafos_sparse(n_images, img_idx, anchor_idx, points,
+                             weights=None, reference=0, solver='direct',
+                             regularization=1e-6):
+  # like get_global_trafos, but from a list of observations: anchor
+  # anchor_idx[k] is at points[k] in image img_idx[k]; this keeps memory
+  # proportional to the number of anchors actually placed
+  img_idx = np.asarray(img_idx, dtype=int)
+  points = np.asarray(points, dtype=float).reshape(-1, 2)
+  w = np.ones(len(img_idx)) if weights is None else np.asarray(weights,
+                                                                dtype=float)
+  sqrt_w = np.sqrt(w)
+  # anchors are numbered in order of appearance in the unknowns
+  used_anchors, anchor_idx = np.unique(np.asarray(anchor_idx, dtype=int),
+                                       return_inverse=True)
+  n_used = len(used_anchors)
+
+  # work in units of the image size to keep the system well conditioned
+  scale = max(np.abs(points).max(), 1.0) if len(points) > 0 else 1.0
+  x, y = (points/scale).T
+
+  # unknowns: a, b, dx, dy for every image but the reference, followed by
+  # the position of each anchor that is seen at least once
+  frame_col = np.arange(n_images) - (np.arange(n_images) > reference)
+  frame_col = 4*frame_col
+  anchor_col = 4*(n_images - 1) + 2*np.arange(n_used)
+  n_unknowns = 4*(n_images - 1) + 2*n_used
+
+  # two rows per observation: a*x + b*y + dx - X = 0, -b*x + a*y + dy - Y = 0
+  n_obs = len(img_idx)
+  is_ref = img_idx == reference
+  rows_x = 2*np.arange(n_obs)
+  rows_y = rows_x + 1
+  base = frame_col[img_idx]
+  ones = np.ones(n_obs)
+  rows = [rows_x, rows_x, rows_x, rows_y, rows_y, rows_y]
+  cols = [base, base + 1, base + 2, base, base + 1, base + 3]
+  vals = [x, y, ones, y, -x, ones]
+  rows = np.concatenate([_[~is_ref] for _ in rows] + [rows_x, rows_y])
+  cols = np.concatenate([_[~is_ref] for _ in cols] +
+                        [anchor_col[anchor_idx], anchor_col[anchor_idx] + 1])
+  vals = np.concatenate([_[~is_ref] for _ in vals] + [-ones, -ones])
+  vals = vals*np.concatenate([sqrt_w[~is_ref]]*6 + [sqrt_w]*2)
+
+  # the reference image's known transformation goes into the right-hand side
+  rhs = np.zeros(2*n_obs)
+  rhs[rows_x[is_ref]] = -x[is_ref]*sqrt_w[is_ref]
+  rhs[rows_y[is_ref]] = -y[is_ref]*sqrt_w[is_ref]
+
+  # a weak pull towards the identity keeps images that the anchors do not
+  # determine from making the system singular; images that are determined
+  # are left alone, so that they come out exact
+  weak = ~get_determined_frames(n_images, img_idx, anchor_idx, reference)
+  weak[reference] = False
+  reg_cols = (frame_col[weak][:, None] + np.arange(4)).ravel()
+  lam = math.sqrt(regularization)
+  rows = np.concatenate([rows, len(rhs) + np.arange(len(reg_cols))])
+  cols = np.concatenate([cols, reg_cols])
+  vals = np.concatenate([vals, lam*np.ones(len(reg_cols))])
+  rhs = np.concatenate([rhs, lam*(np.arange(len(reg_cols)) % 4 == 0)])
+
+  mat = scipy.sparse.csr_matrix((vals, (rows, cols)),
+                                shape=(len(rhs), n_unknowns))
+  if solver == 'direct':
+    soln = solve_block_normal(mat, rhs, n_images - 1)
+  elif solver == 'lsqr':
+    soln = scipy.sparse.linalg.lsqr(mat, rhs, atol=1e-12, btol=1e-12,
+                                    iter_lim=10*n_unknowns)[0]
+  else:
+    raise Exception("Unrecognized solver.")
+
+  params = np.tile([1.0, 0, 0, 0], (n_images, 1))
+  others = np.arange(n_images) != reference
+  params[others] = soln[:4*(n_images - 1)].reshape(-1, 4)
+  params[:, 2:] *= scale
+  return (params, get_trafo_matrices(params))
+
+def get_determined_frames(n_images, img_idx, anchor_idx, reference=0):
+  # mask of the images whose transformations the observations pin down:
+  # those linked to the reference image through shared anchors, with at
+  # least two observations of anchors that some other image sees, too
+  n_anchors = anchor_idx.max() + 1 if len(anchor_idx) > 0 else 0
+  graph = scipy.sparse.coo_matrix((np.ones(len(img_idx)),
+                                   (img_idx, n_images + anchor_idx)),
+                                  shape=(n_images + n_anchors,)*2)
+  labels = scipy.sparse.csgraph.connected_components(graph,
+                                                     directed=False)[1]
+  linked = labels[:n_images] == labels[reference]
+
+  shared = np.bincount(anchor_idx, minlength=n_anchors)[anchor_idx] >= 2
+  n_shared = np.bincount(img_idx[shared], minlength=n_images)
+  return linked & (n_shared >= 2)
+
+def parse_command_line():
+  parser = argparse.ArgumentParser(
+    description="Find transformations aligning an image set.",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('anchors', help="file containing anchor positions")
+  parser.add_argument('-p', '--processed', action='store_true',
+                      help="output alpha, x, y, theta instead of a, b, dx, dy")
+  parser.add_argument('--pad', default="1000,1000",
+                      help="padding of the final image, with --processed")
+  parser.add_argument('--dims', default="5000,7000",
+                      help="size of the final image, with --processed")
+  parser.add_argument('--model', default='similarity',
+                      choices=['similarity', 'affine', 'homography'],
+                      help="kind of transformation to fit; models other "
+                          +"than similarity need --matrices")
+  parser.add_argument('-m', '--matrices', default=None,
+                      help="file where to store the transformation matrices, "
+                          +"which imtransform can render directly")
+  parser.add_argument('-w', '--weights', default=None,
+                      help="file containing per-anchor confidence weights, "
+                          +"in the same layout as the anchor file")
+  parser.add_argument('-r', '--reference', type=int, default=0,
+                      help="index of the image that all others are aligned "
+                          +"to")
+  parser.add_argument('-g', '--global', dest='global_fit', action='store_true',
+                      help="solve for all transformations jointly, using "
+                          +"anchors that are not visible in the reference "
+                          +"image, too")
+  parser.add_argument('--solver', default='direct', choices=['direct', 'lsqr'],
+                      help="sparse solver used with --global")
+  parser.add_argument('--robust', default=None,
+                      choices=['ransac', 'huber', 'tukey'],
+                      help="estimate transformations so that misplaced "
+                          +"anchors are ignored; with --global, the anchors "
+                          +"found to be outliers are left out of the joint "
+                          +"fit")
+  parser.add_argument('--threshold', type=float, default=20.0,
+                      help="residual, in pixels, beyond which an anchor is "
+                          +"an outlier, with --robust")
+  parser.add_argument('--inliers', default=None,
+                      help="file where to store which anchors are inliers, "
+                          +"with --robust; it can be used as a weights file")
+
+  args = parser.parse_args()
+
+  return args
+
 if __name__ == "__main__":
-  all_anchors = read_anchors(sys.argv[1])[1]
-
-  target_anchor_matrix = create_anchor_matrix(all_anchors[0])
-  trafos = [get_best_trafo(create_anchor_matrix(_), target_anchor_matrix)
-            for _ in all_anchors]
-
-  if len(sys.argv) >= 3 and sys.argv[2] in ['--processed', '-p']:
-    # XXX final image size should ideally be configurable...
-    pad_x = 1000.0
-    pad_y = 1000.0
-    width = 5000.0
-    height = 7000.0
-
-    w2 = width/2.0
-    h2 = height/2.0
-    
-    for i, trafo in enumerate(trafos):
-      a = trafo[0]['a']
-      b = trafo[0]['b']
-      alpha = np.sqrt(a**2 + b**2)
-      dx = trafo[0]['dx']
-      dy = trafo[0]['dy']
-      
-      new_dict = {}
-      new_dict['alpha'] = alpha
-      new_dict['theta'] = np.arctan2(b, a)
-      
-      new_dict['x'] = ((a*(dx + pad_x*(1-a)) - b*(dy + pad_y + pad_x*b))/alpha +
-          w2*(1 - a/alpha) + h2*b/alpha)
-      new_dict['y'] = ((a*(dy + pad_y*(1-a)) + b*(dx + pad_x - pad_y*b))/alpha +
-          h2*(1 - a/alpha) - w2*b/alpha)
-      
-#      new_dict['x'] = (a*trafo[0]['dx'] - b*trafo[0]['dy']) / new_dict['alpha']
-#      new_dict['y'] = (a*trafo[0]['dy'] + b*trafo[0]['dx']) / new_dict['alpha']
-      trafos[i] = (new_dict, ) + trafo[1:]
+  args = parse_command_line()
+  if args.model != 'similarity':
+    if args.matrices is None:
+      sys.exit("The {} model can only be written with --matrices.".format(
+          args.model))
+    if args.global_fit or args.processed:
+      sys.exit("--global and --processed only work with the similarity "
+               "model.")
+
+  anchor_names, anchor_array = read_anchor_array(args.anchors)
+  weights = None if args.weights is None else read_weights(args.weights)
+  target_anchors = anchor_array[args.reference]
+  if args.robust is not None:
+    params, matrices, inliers = get_robust_trafos(anchor_array,
+        target_anchors, weights, method=args.robust,
+        threshold=args.threshold)
+    residuals = get_residuals(anchor_array, target_anchors, matrices)
+    outliers = (get_anchor_weights(anchor_array, target_anchors, weights) > 0)
+    outliers &= ~inliers
+    for i, k in zip(*np.nonzero(outliers)):
+      sys.stderr.write("WARNING: anchor '{}' in image {} looks misplaced "
+                       "(residual {:.1f} pixels).\n".format(anchor_names[k],
+                                                            i+1,
+                                                            residuals[i, k]))
+    if args.inliers is not None:
+      write_weights(args.inliers, anchor_names, inliers)
+
+    # the joint fit uses only the inliers; the reference image's anchors are
+    # all kept
+    if args.global_fit:
+      inliers[args.reference] = True
+      weights = (np.ones(inliers.shape) if weights is None else
+                 weights)*inliers
+
+  if args.global_fit:
+    params, matrices = get_global_trafos(anchor_array, weights,
+        reference=args.reference, solver=args.solver)
+    usable = np.isfinite(anchor_array).all(axis=-1)
+    if weights is not None:
+      usable &= weights > 0
+  else:
+    if args.robust is None:
+      params, matrices = get_best_trafos(anchor_array, target_anchors,
+                                         weights)
+    usable = get_anchor_weights(anchor_array, target_anchors, weights) > 0
+    if args.robust is not None:
+      usable &= inliers
+    if args.model != 'similarity':
+      # outliers found with the similarity model are left out of the fit
+      model_weights = weights
+      if args.robust is not None:
+        model_weights = np.where(usable, 1.0 if weights is None else weights,
+                                 0.0)
+      matrices = get_model_trafos(anchor_array, target_anchors, model_weights,
+                                  model=args.model)
+  trafos = [(dict(zip(trafo_params, p)), m) for p, m in zip(params, matrices)]
+
+  min_anchors = model_min_anchors[args.model]
+  for i in np.flatnonzero(usable.sum(axis=-1) < min_anchors):
+    sys.stderr.write("WARNING: image {} has fewer than {} usable anchors; "
+                     "its transformation is not determined.\n".format(
+                         i+1, min_anchors))
+
+  if args.matrices is not None:
+    write_trafo_matrices(args.matrices, matrices, model=args.model)
+    if args.model != 'similarity':
+      sys.exit(0)
+
+  if args.processed:
+    pad_x, pad_y = [float(_) for _ in args.pad.split(',')]
+    width, height = [float(_) for _ in args.dims.split(',')]
+    processed = get_processed_params([[trafo[0][p] for p in trafo_params]
+                                      for trafo in trafos], (pad_x, pad_y),
+                                     (width, height))
     params = ['alpha', 'x', 'y', 'theta']
+    for i, trafo in enumerate(trafos):
+      trafos[i] = (dict(zip(params, processed[i])), ) + trafo[1:]
 
     print('# pad = {}, dims = {}'.format((pad_x, pad_y), (width, height)))
-  else:  
+  else:
     params = trafos[0][0].keys()
-  
+
   print('\t'.join(params))
   for trafo in trafos:
     print('\t'.join(str(trafo[0][p]) for p in params))
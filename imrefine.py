@@ -0,0 +1,274 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import argparse
+import itertools
+import sys
+
+from multiprocessing import Pool
+
+import numpy as np
+import scipy.ndimage
+from PIL import Image
+
+from imio import read_anchor_array, write_anchor_array
+from imoptim import get_best_trafos
+
+# Refine clicked anchors to sub-pixel accuracy. For every anchor, a patch
+# around it in the reference image serves as the template; the matching
+# patch in every other image is resampled around the clicked position, with
+# the rotation and scale of the current transformation estimate taken out,
+# and the remaining shift is found by phase correlation. All anchor/image
+# pairs in a batch of images are correlated with one FFT call. This is done
+# first on reduced-resolution decodes, to catch larger errors, and then at
+# full resolution.
+
+def parse_command_line():
+  parser = argparse.ArgumentParser(
+    description="Refine anchor positions by matching image patches.",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('files', type=str, nargs='+',
+                      help="a file in the image set")
+  parser.add_argument('-a', '--anchors', default='img_anchors.txt',
+                      help="file containing the clicked anchor positions")
+  parser.add_argument('-o', '--output', default='img_anchors_refined.txt',
+                      help="where to store the refined anchor positions")
+  parser.add_argument('-r', '--reference', type=int, default=0,
+                      help="index of the image whose anchors are used as "
+                          +"templates; these are not changed")
+  parser.add_argument('-p', '--patch-size', type=int, default=64,
+                      help="size of the patches that are matched, in pixels "
+                          +"at each scale")
+  parser.add_argument('-s', '--scales', default="0.25,1",
+                      help="image scales at which to refine, in order")
+  parser.add_argument('-i', '--iterations', type=int, default=3,
+                      help="number of matching passes at each scale")
+  parser.add_argument('--min-score', type=float, default=0.05,
+                      help="smallest phase-correlation peak for which a "
+                          +"match is accepted")
+  parser.add_argument('-b', '--batch', type=int, default=32,
+                      help="number of images correlated together")
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help="number of processes used for decoding")
+
+  args = parser.parse_args()
+
+  return args
+
+def read_gray(fname, scale):
+  # grayscale pixels at roughly the given scale, using JPEG draft mode when
+  # possible; returns the image as a float array and the actual scale
+  img = Image.open(fname)
+  full_width = img.size[0]
+  if scale < 1:
+    img.draft('L', (int(img.size[0]*scale), int(img.size[1]*scale)))
+  img = img.convert('L')
+  return (np.asarray(img, dtype=np.float32), float(img.size[0])/full_width)
+
+def get_patch_grid(patch_size):
+  # offsets of the patch pixels from its center, shape (2, P, P) as (x, y)
+  offsets = np.arange(patch_size) - patch_size//2
+  return np.asarray(np.meshgrid(offsets, offsets), dtype=float)
+
+def to_scaled(points, scale):
+  # full-resolution pixel coordinates to those of an image decoded at `scale`
+  return (points + 0.5)*scale - 0.5
+
+def extract_regions(job):
+  # cut a square region of the given size around each anchor, so that the
+  # patches can be resampled repeatedly without decoding the image again;
+  # returns the regions, the scaled coordinates of their centers and the
+  # scale; regions of missing anchors are all zero
+  fname, anchors, scale, region_size = job
+  gray, actual_scale = read_gray(fname, scale)
+
+  valid = np.isfinite(anchors).all(axis=-1)
+  centers = np.round(to_scaled(np.where(valid[:, None], anchors, 0),
+                               actual_scale))
+  grid = get_patch_grid(region_size).reshape(2, -1)
+  x = centers[:, 0, None] + grid[0]
+  y = centers[:, 1, None] + grid[1]
+  regions = scipy.ndimage.map_coordinates(gray, [y.ravel(), x.ravel()],
+                                          order=1, mode='constant', cval=0)
+  regions = regions.reshape(len(anchors), region_size, region_size)
+  regions[~valid] = 0
+  return (regions.astype(np.float32), centers, actual_scale)
+
+def sample_patches(regions, offsets, linear, patch_size):
+  # patches of shape (n, P, P) from regions of shape (n, R, R); `offsets` are
+  # the positions of the patch centers relative to the region centers, and
+  # `linear` (n, 2, 2) maps patch offsets to region offsets
+  n, region_size = regions.shape[:2]
+  grid = get_patch_grid(patch_size).reshape(2, -1)
+  coords = np.einsum('nij,jp->nip', linear, grid) + offsets[:, :, None]
+  coords += region_size//2
+  index = np.repeat(np.arange(n, dtype=float), grid.shape[1])
+  patches = scipy.ndimage.map_coordinates(regions,
+      [index, coords[:, 1].ravel(), coords[:, 0].ravel()], order=1,
+      mode='constant', cval=0)
+  return patches.reshape(n, patch_size, patch_size)
+
+def get_window(patch_size):
+  window = np.hanning(patch_size)
+  return np.outer(window, window).astype(np.float32)
+
+def get_spectra(patches, window):
+  # windowed, mean-free patches in the Fourier domain
+  patches = patches - patches.mean(axis=(-2, -1), keepdims=True)
+  return np.fft.rfft2(patches*window)
+
+def phase_correlate(spectra, ref_spectra, peak_width=1.5, shape=None):
+  # shift of each patch relative to its template, and the height of the
+  # correlation peak; spectra have shape (..., H, W//2 + 1), and the
+  # templates broadcast; `shape` is (H, W), with square patches assumed if
+  # it is not given. The whitened cross-power spectrum is multiplied by a
+  # Gaussian so that the peak is a Gaussian of the given width, and a
+  # parabola through the logarithm of the peak and its neighbors gives the
+  # sub-pixel position.
+  if shape is None:
+    shape = (spectra.shape[-2], spectra.shape[-2])
+  height, width = shape
+  cross = spectra*np.conj(ref_spectra)
+  cross /= np.maximum(np.abs(cross), 1e-12)
+  fy = np.fft.fftfreq(height)[:, None]
+  fx = np.fft.rfftfreq(width)[None, :]
+  weight = np.exp(-2*(np.pi*peak_width)**2*(fx**2 + fy**2))
+  # normalized so that a perfect match scores 1
+  weight /= np.fft.irfft2(weight, s=shape)[0, 0]
+  corr = np.fft.irfft2(cross*weight, s=shape)
+
+  flat = corr.reshape(corr.shape[:-2] + (-1, ))
+  peak = flat.argmax(axis=-1)
+  py, px = np.unravel_index(peak, shape)
+  score = flat.max(axis=-1)
+
+  idx = tuple(np.indices(py.shape))
+  def log_at(yy, xx):
+    return np.log(np.maximum(corr[idx + (yy % height, xx % width)], 1e-6))
+
+  def refine(c_minus, c0, c_plus):
+    denom = c_minus - 2*c0 + c_plus
+    ok = denom < -1e-12
+    return np.where(ok, 0.5*(c_minus - c_plus)/np.where(ok, denom, -1), 0)
+
+  c0 = log_at(py, px)
+  dx = refine(log_at(py, px - 1), c0, log_at(py, px + 1))
+  dy = refine(log_at(py - 1, px), c0, log_at(py + 1, px))
+
+  # peaks past the middle correspond to negative shifts
+  shift_x = np.where(px > width//2, px - width, px) + dx
+  shift_y = np.where(py > height//2, py - height, py) + dy
+  return (np.stack([shift_x, shift_y], axis=-1), score)
+
+def get_linear_parts(anchors, reference):
+  # rotation and scale taking each image to the reference, from the current
+  # anchors
+  matrices = get_best_trafos(anchors, anchors[reference])[1]
+  return matrices[:, :2, :2]
+
+def refine_anchors(files, anchors, reference=0, patch_size=64,
+                   scales=(0.25, 1), iterations=3, min_score=0.05, batch=32,
+                   jobs=1):
+  # returns refined anchors and, for each anchor, whether a match was
+  # accepted at the finest scale
+  anchors = np.array(anchors, dtype=float)
+  n_images, n_anchors = anchors.shape[:2]
+  others = [_ for _ in range(n_images) if _ != reference]
+  window = get_window(patch_size)
+  region_size = 2*patch_size
+  accepted = np.zeros((n_images, n_anchors), dtype=bool)
+
+  pool = Pool(jobs) if jobs > 1 else None
+  imap = pool.imap if pool is not None else itertools.imap
+  try:
+    for scale in scales:
+      inverse = np.linalg.inv(get_linear_parts(anchors, reference))
+
+      # the reference patches are cut at the anchors themselves
+      ref_regions, ref_centers, ref_scale = extract_regions((files[reference],
+          anchors[reference], scale, region_size))
+      ref_offsets = to_scaled(anchors[reference], ref_scale) - ref_centers
+      ref_offsets[~np.isfinite(ref_offsets)] = 0
+      ref_spectra = get_spectra(sample_patches(ref_regions, ref_offsets,
+          np.tile(np.eye(2), (n_anchors, 1, 1)), patch_size), window)
+      ref_valid = np.isfinite(anchors[reference]).all(axis=-1)
+
+      results = imap(extract_regions, [(files[i], anchors[i], scale,
+                                        region_size) for i in others])
+      for start in range(0, len(others), batch):
+        chunk = others[start:start + batch]
+        regions, centers, image_scales = zip(*[next(results) for _ in chunk])
+        regions = np.concatenate(regions)
+        centers = np.concatenate(centers)
+        image_scales = np.repeat(image_scales, n_anchors)
+
+        # positions are tracked at full resolution; the linear part is
+        # adjusted for the scales of the two decodes
+        positions = anchors[chunk].reshape(-1, 2)
+        valid = np.isfinite(positions).all(axis=-1) & np.tile(ref_valid,
+                                                              len(chunk))
+        positions = np.where(valid[:, None], positions, 0)
+        linear = np.repeat(inverse[chunk], n_anchors, axis=0)
+        linear *= (image_scales/ref_scale)[:, None, None]
+
+        # windowing biases the shifts towards zero, so the patches are cut
+        # again at the updated positions a few times
+        for _ in range(iterations):
+          offsets = to_scaled(positions, image_scales[:, None]) - centers
+          patches = sample_patches(regions, offsets, linear, patch_size)
+          shifts, score = phase_correlate(get_spectra(patches, window),
+                                          np.tile(ref_spectra,
+                                                  (len(chunk), 1, 1)))
+          # shifts are in reference pixels at this scale
+          delta = np.einsum('nij,nj->ni', linear, shifts)
+          positions += delta/image_scales[:, None]
+
+          # matches must stay within the regions that were cut out
+          offsets = to_scaled(positions, image_scales[:, None]) - centers
+          valid &= np.abs(offsets).max(axis=-1) < (region_size -
+                                                  patch_size)//2
+
+        valid &= score >= min_score
+        positions = positions.reshape(len(chunk), n_anchors, 2)
+        valid = valid.reshape(len(chunk), n_anchors)
+        for k, i in enumerate(chunk):
+          anchors[i][valid[k]] = positions[k][valid[k]]
+          accepted[i] = valid[k]
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+  accepted[reference] = np.isfinite(anchors[reference]).all(axis=-1)
+  return (anchors, accepted)
+
+if __name__ == "__main__":
+  args = parse_command_line()
+  files = list(args.files)
+  files.sort()
+
+  anchor_names, anchors = read_anchor_array(args.anchors)
+  if anchors is None:
+    sys.exit("Cannot read anchors from {}.".format(args.anchors))
+  if len(files) != len(anchors):
+    sys.exit("There are {} files but {} rows of anchors.".format(
+        len(files), len(anchors)))
+
+  refined, accepted = refine_anchors(files, anchors,
+      reference=args.reference, patch_size=args.patch_size,
+      scales=[float(_) for _ in args.scales.split(',')],
+      iterations=args.iterations, min_score=args.min_score,
+      batch=args.batch, jobs=args.jobs)
+
+  clicked = np.isfinite(anchors).all(axis=-1)
+  shifts = np.sqrt(((refined - anchors)**2).sum(axis=-1))[accepted]
+  print("Refined {} of {} anchors; median change {:.2f} pixels.".format(
+      accepted.sum(), clicked.sum(),
+      np.median(shifts) if len(shifts) > 0 else 0.0))
+  for i, k in zip(*np.nonzero(clicked & ~accepted)):
+    sys.stderr.write("WARNING: no good match for anchor '{}' in image {}; "
+                     "keeping the clicked position.\n".format(
+                         anchor_names[k], i+1))
+
+  write_anchor_array(args.output, anchor_names, np.round(refined, 3))
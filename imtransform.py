@@ -3,32 +3,22 @@
 from __future__ import print_function
 
 import argparse
-import ast
+import hashlib
 import os
 import math
+import sys
+import threading
+import time
+import Queue
 
-from PIL import Image
+from multiprocessing import Pool
 
-import numpy as np
+from PIL import Image, ImageFilter
 
-def read_anchors(fname):
-  try:
-    with open(fname, 'rt') as f:
-      header = f.readline().strip()
-      anchor_names = [_.strip() for _ in header.split('\t')]
-      anchors = []
-      while True:
-        line = f.readline()
-        if len(line) == 0:
-          break
-
-        anchors_str = [_.strip() for _ in line.strip().split('\t')]
-        anchors_tup = [ast.literal_eval(_) for _ in anchors_str]
-        anchors.append(anchors_tup)
-  except IOError:
-    return (None, None)
+import numpy as np
 
-  return (anchor_names, anchors)
+from imio import read_anchor_array, read_trafos, get_params_from_processed
+from imio import is_trafo_matrix_file, read_trafo_matrices
 
 def parse_command_line():
   parser = argparse.ArgumentParser(
@@ -39,7 +29,8 @@ def parse_command_line():
   parser.add_argument('-o', '--output', default=None,
                       help="folder where to store anchor positions")
   parser.add_argument('-p', '--params', help="file containing transformation "+
-                      "parameters.")
+                      "parameters, or transformation matrices (as written "+
+                      "by imoptim --matrices).")
   parser.add_argument('-a', '--anchors', default=None,
                       help="file containing untransformed anchor positions")
   parser.add_argument('--crop', default=None,
@@ -47,148 +38,620 @@ def parse_command_line():
                           +"x0, y0, x1, y1)")
   parser.add_argument('-s', '--final-size', default="720,1280",
                       help="final image size (two numbers separated by comma)")
+  parser.add_argument('-r', '--render', default='affine',
+                      choices=['affine', 'legacy'],
+                      help="rendering method: 'affine' resamples each pixel "
+                          +"once with a single composed warp (perspective "
+                          +"for homographies), 'legacy' scales, rotates, "
+                          +"crops and resizes in turn")
+  parser.add_argument('--no-draft', dest='draft', action='store_false',
+                      help="always decode the source images at full "
+                          +"resolution")
+  parser.add_argument('--preview', action='store_true',
+                      help="quickly render the sequence at low resolution, "
+                          +"into a 'preview' folder inside the output folder")
+  parser.add_argument('-f', '--force', action='store_true',
+                      help="render all images, even those that did not "
+                          +"change since the last run")
+  parser.add_argument('-t', '--tile-height', type=int, default=0,
+                      help="render the output in strips of this many rows, "
+                          +"to bound memory use for very large sources "
+                          +"(0 for no tiling; 'affine' rendering only)")
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help="number of images to render in parallel")
+  parser.add_argument('--threads', default="1,1,1",
+                      help="number of threads decoding, warping and encoding "
+                          +"images (three numbers separated by commas); "
+                          +"only used when --jobs is 1")
 
   args = parser.parse_args()
 
+  try:
+    args.threads = tuple(int(word) for word in args.threads.split(','))
+  except ValueError:
+    args.threads = ()
+  if len(args.threads) != 3 or min(args.threads) < 1:
+    parser.error("--threads needs three positive numbers separated by "
+                 "commas.")
+
   return args
 
-def parse_key_tuple(s, key):
-  idx1 = s.find(key)
-  if idx1 >= 0:
-    expr = s[idx1+len(key):].strip()
-    if expr[0] == '=':
-      expr = expr[1:].strip()
-      if expr[0] == '(':
-        idx1e = expr.find(')')
-        if idx1e >= 0:
-          expr = expr[:idx1e+1]
-          return ast.literal_eval(expr)
-
-  return None
-
-def read_trafos(fname):
-  with open(fname, 'rt') as f:
-    trafos = []
-    first_comment = None
-    header = None
-    pad_x = 0
-    pad_y = 0
-    width = 5500
-    height = 3500
+def get_final_size(crop_region, final_size):
+  final_width = float(crop_region[2] - crop_region[0])
+  final_height = float(crop_region[3] - crop_region[1])
+  ratio = min(final_size[0]/final_width, final_size[1]/final_height)
+  return (int(round(final_width*ratio)), int(round(final_height*ratio)))
+
+def get_trafo_matrix(trafo):
+  # matrix mapping source image coordinates to aligned coordinates
+  if 'matrix' in trafo:
+    return np.asarray(trafo['matrix'], dtype=float)
+  a = trafo['a']
+  b = trafo['b']
+  return np.asarray([[a, b, trafo['dx']], [-b, a, trafo['dy']], [0, 0, 1.0]])
+
+def get_output_matrix(crop_region, final_size_mod=None, final_size=None):
+  # matrix mapping output image coordinates to aligned coordinates; the output
+  # is the crop region scaled to final_size_mod and centered in final_size
+  if final_size_mod is None:
+    return np.asarray([[1, 0, crop_region[0]], [0, 1, crop_region[1]],
+                       [0, 0, 1.0]])
+
+  scale_x = float(crop_region[2] - crop_region[0])/final_size_mod[0]
+  scale_y = float(crop_region[3] - crop_region[1])/final_size_mod[1]
+  off_x = (final_size[0] - final_size_mod[0])//2
+  off_y = (final_size[1] - final_size_mod[1])//2
+  return np.asarray([[scale_x, 0, crop_region[0] - scale_x*off_x],
+                     [0, scale_y, crop_region[1] - scale_y*off_y],
+                     [0, 0, 1.0]])
+
+MATRIX_GRID = 2.0**20
+
+def is_affine(matrix):
+  return matrix[2, 0] == 0 and matrix[2, 1] == 0 and matrix[2, 2] == 1
+
+def get_source_corners(matrix, size):
+  # source positions of the corners of an output region, or None if part of
+  # the region maps beyond the horizon of a perspective matrix
+  corners = np.asarray([[0, size[0], size[0], 0],
+                        [0, 0, size[1], size[1]],
+                        [1, 1, 1, 1.0]])
+  src = np.dot(matrix, corners)
+  if not (src[2] > 0).all():
+    return None
+  return src[:2]/src[2]
+
+def get_source_scale(matrix, size):
+  # how many source pixels fall on one output pixel; for perspective
+  # matrices, this is the average over the output region
+  if is_affine(matrix):
+    return math.sqrt(abs(np.linalg.det(matrix[:2, :2])))
+  src = get_source_corners(matrix, size)
+  if src is None:
+    return 1.0
+  x, y = src
+  area = 0.5*abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
+  return math.sqrt(area/(size[0]*size[1]))
+
+def warp_region(img, matrix, size, resample=Image.BICUBIC, scale=None):
+  # resample `img` once, with `matrix` mapping output pixel coordinates to
+  # source pixel coordinates; the matrix can be projective. `scale` sets the
+  # antialiasing, and is found from the matrix if not given
+  # find the part of the source that is actually needed
+  affine = is_affine(matrix)
+  src = get_source_corners(matrix, size)
+  if src is None:
+    src = np.asarray([[0, img.size[0]], [0, img.size[1]]])
+
+  # antialias according to how many source pixels fall on one output pixel;
+  # the margin covers the support of the three box blurs PIL uses for the
+  # Gaussian and that of the bicubic filter, so that output pixels do not
+  # depend on where the source is cropped
+  if scale is None:
+    scale = get_source_scale(matrix, size)
+  radius = math.sqrt(scale**2 - 1)/2 if scale > 1 else 0.0
+  margin = 3*int(math.ceil(radius)) + 3
+
+  box = (max(int(math.floor(src[0].min())) - margin, 0),
+         max(int(math.floor(src[1].min())) - margin, 0),
+         min(int(math.ceil(src[0].max())) + margin, img.size[0]),
+         min(int(math.ceil(src[1].max())) + margin, img.size[1]))
+  if box[2] <= box[0] or box[3] <= box[1]:
+    return Image.new(img.mode, size)
+
+  img_src = img.crop(box)
+  if radius > 0:
+    img_src = img_src.filter(ImageFilter.GaussianBlur(radius))
+
+  if affine:
+    data = (matrix[0, 0], matrix[0, 1], matrix[0, 2] - box[0],
+            matrix[1, 0], matrix[1, 1], matrix[1, 2] - box[1])
+    return img_src.transform(size, Image.AFFINE, data, resample)
+
+  shift = np.asarray([[1, 0, -box[0]], [0, 1, -box[1]], [0, 0, 1.0]])
+  shifted = np.dot(shift, matrix)
+  data = tuple((shifted/shifted[2, 2]).ravel()[:8])
+  return img_src.transform(size, Image.PERSPECTIVE, data, resample)
+
+def warp_affine(img, matrix, size, resample=Image.BICUBIC, tile_height=None):
+  # round the matrix to a binary grid fine enough not to matter; with that,
+  # the coordinates PIL computes for each output pixel come out exactly the
+  # same whether or not the output is split into strips (perspective warps
+  # divide by a per-strip denominator, so there strips can differ in the
+  # last bits)
+  if is_affine(matrix):
+    matrix = np.round(matrix*MATRIX_GRID)/MATRIX_GRID
+  # perspective warps are antialiased by the same amount in every strip
+  scale = get_source_scale(matrix, size)
+  if tile_height is None or tile_height <= 0 or tile_height >= size[1]:
+    return warp_region(img, matrix, size, resample, scale)
+
+  # render in horizontal strips, each of which only crops, filters and
+  # resamples the part of the source it needs, so that the intermediate
+  # images stay proportional to the strip size
+  img_out = Image.new(img.mode, size)
+  for y0 in xrange(0, size[1], tile_height):
+    height = min(tile_height, size[1] - y0)
+    shift = np.asarray([[1, 0, 0], [0, 1, y0], [0, 0, 1.0]])
+    img_out.paste(warp_region(img, np.dot(matrix, shift), (size[0], height),
+                              resample, scale), (0, y0))
+
+  return img_out
+
+def draw_anchors(img, img_anchors):
+  n_anchors = len(img_anchors)
+  for j in xrange(n_anchors):
+    anchor = np.asarray(img_anchors[j])
+    img.putpixel(anchor, (255, 0, 0))
+    for k in xrange(-8, 8):
+      for l in xrange(-8, 8):
+        img.putpixel(anchor + (k, l), (255, 0, 0))
+
+def render_affine(img0, trafo, crop_region, final_size_mod, final_size,
+                  tile_height=None):
+  # compose output -> aligned -> source into a single matrix
+  out_matrix = get_output_matrix(crop_region, final_size_mod, final_size)
+  matrix = np.dot(np.linalg.inv(get_trafo_matrix(trafo)), out_matrix)
+  if final_size_mod is not None:
+    size = final_size
+  else:
+    size = (int(round(crop_region[2] - crop_region[0])),
+            int(round(crop_region[3] - crop_region[1])))
+
+  return warp_affine(img0, matrix, size, tile_height=tile_height)
+
+def render_legacy(img0, trafo, crop_region, final_size_mod, final_size,
+                  tile_height=None):
+  # tiling is not supported here; tile_height is ignored
+  if 'matrix' in trafo:
+    if trafo['model'] != 'similarity':
+      raise Exception("The legacy renderer only handles similarity "
+                      "transformations.")
+    matrix = get_trafo_matrix(trafo)
+    trafo = {'a': matrix[0, 0], 'b': matrix[0, 1], 'dx': matrix[0, 2],
+             'dy': matrix[1, 2]}
+
+  alpha = math.sqrt(trafo['a']**2 + trafo['b']**2)
+  theta = math.atan2(trafo['b'], trafo['a'])
+  dx = trafo['dx']
+  dy = trafo['dy']
+
+  # first scale
+  img1 = img0.resize((int(round(alpha*_)) for _ in img0.size),
+                      Image.ANTIALIAS)
+  
+  # next rotate, expanding as necessary
+  img2 = img1.rotate(180.0*theta/math.pi, resample=Image.BICUBIC,
+                     expand=True)
+
+  # then we would need to shift by (dx, dy), plus some amount because we
+  # rotate around center instead of corner
+  # and crop around the center of the resulting image
+  # that means that we need to crop around img2.size/2 - (dx, dy)
+
+  # now crop
+  c = math.cos(theta)
+  s = math.sin(theta)
+  rot_x = -img2.size[0]/2.0 + img1.size[0]/2.0*c + img1.size[1]/2.0*s
+  rot_y = -img2.size[1]/2.0 + img1.size[1]/2.0*c - img1.size[0]/2.0*s
+  corner_x = -dx - rot_x
+  corner_y = -dy - rot_y
+  crop_region_crt = (int(round(corner_x + crop_region[0])),
+                     int(round(corner_y + crop_region[1])),
+                     int(round(corner_x + crop_region[2])),
+                     int(round(corner_y + crop_region[3])))
+  img3 = img2.crop(crop_region_crt)
+
+  if final_size_mod is not None:
+    img4 = img3.resize(final_size_mod, Image.ANTIALIAS)
+    img_final = Image.new(img4.mode, final_size)
+    img_final.paste(img4, tuple(
+        (img_final.size[_] - img4.size[_])/2 for _ in xrange(2)))
+  else:
+    img_final = img3
+
+  return img_final
+
+renderers = {'affine': render_affine, 'legacy': render_legacy}
+
+PREVIEW_SCALE = 0.25
+PREVIEW_DIR = 'preview'
+
+MANIFEST_NAME = 'manifest.txt'
+
+def get_render_scale(trafo, crop_region, final_size_mod):
+  # how many output pixels correspond to one source pixel; for homographies
+  # this is only the scale of their linear part
+  if 'matrix' in trafo:
+    matrix = get_trafo_matrix(trafo)
+    alpha = math.sqrt(abs(np.linalg.det(matrix[:2, :2]/matrix[2, 2])))
+  else:
+    alpha = math.sqrt(trafo['a']**2 + trafo['b']**2)
+  if final_size_mod is None:
+    return alpha
+  return alpha*min(final_size_mod[0]/float(crop_region[2] - crop_region[0]),
+                   final_size_mod[1]/float(crop_region[3] - crop_region[1]))
+
+def open_draft(fname, scale):
+  # use the JPEG decoder's DCT scaling to decode at 1/2, 1/4 or 1/8 of the
+  # full resolution whenever the output does not need more than that;
+  # returns the image and the factor by which it was shrunk
+  img = Image.open(fname)
+  if scale >= 0.5:
+    return (img, 1.0)
+
+  size0 = img.size
+  img.draft(img.mode, tuple(int(math.ceil(scale*_)) for _ in size0))
+  if img.size == size0:
+    return (img, 1.0)
+
+  # the decoder shrinks by an exact power of two, rounding sizes up
+  return (img, 1.0/round(float(size0[0])/img.size[0]))
+
+def scale_trafo(trafo, factor):
+  # adjust a transformation to an image that was shrunk by `factor`
+  trafo = dict(trafo)
+  if 'matrix' in trafo:
+    trafo['matrix'] = np.dot(get_trafo_matrix(trafo),
+                             np.diag([1/factor, 1/factor, 1.0]))
+    return trafo
+  trafo['a'] = trafo['a']/factor
+  trafo['b'] = trafo['b']/factor
+  return trafo
+
+def check_trafo(trafo):
+  # returns the transformation in a form the renderers understand, turning
+  # alpha, x, y, theta back into a, b, dx, dy
+  keys = sorted(trafo.keys())
+  if keys == sorted(['alpha','x', 'y', 'theta', 'pad', 'dims']):
+    if trafo['pad'] is None or trafo['dims'] is None:
+      raise Exception("Transformations given as alpha, x, y, theta need the "
+                      "pad and dims they were made with.")
+    a, b, dx, dy = get_params_from_processed([[trafo['alpha'], trafo['x'],
+        trafo['y'], trafo['theta']]], trafo['pad'], trafo['dims'])[0]
+    return {'a': a, 'b': b, 'dx': dx, 'dy': dy, 'pad': trafo['pad'],
+            'dims': trafo['dims']}
+  elif keys == sorted(['matrix', 'model']):
+    if np.asarray(trafo['matrix']).shape != (3, 3):
+      raise Exception("Transformation matrices must be 3x3.")
+    return trafo
+  elif keys != sorted(['a', 'b', 'dx', 'dy', 'pad', 'dims']):
+    raise Exception("Unrecognized transformation parameters.");
+  return trafo
+
+def stage(fct):
+  # errors are stored with the frame instead of raised, so that a bad file
+  # does not stop the rest of the sequence from being rendered
+  def wrapped(frame):
+    if frame['error'] is None:
+      try:
+        fct(frame)
+      except Exception as e:
+        frame['error'] = "{}: {}".format(type(e).__name__, e)
+        frame['img'] = None
+    return frame
+
+  wrapped.__name__ = fct.__name__
+  return wrapped
+
+@stage
+def decode_frame(frame):
+  job = frame['job']
+  trafo = job['trafo']
+  if job['draft']:
+    scale = get_render_scale(trafo, job['crop'], job['final_size_mod'])
+    img0, factor = open_draft(job['fname'], scale)
+  else:
+    img0, factor = Image.open(job['fname']), 1.0
+
+  img_anchors = job['anchors']
+  if factor != 1.0:
+    trafo = scale_trafo(trafo, factor)
+    if img_anchors is not None:
+      img_anchors = [tuple(int(round(factor*_)) for _ in anchor)
+                     for anchor in img_anchors]
+
+  # decode here instead of lazily in the warp stage
+  img0.load()
+  if img_anchors is not None:
+    draw_anchors(img0, img_anchors)
+
+  frame['img'] = img0
+  frame['trafo'] = trafo
+
+@stage
+def warp_frame(frame):
+  job = frame['job']
+  frame['img'] = renderers[job['render']](frame['img'], frame['trafo'],
+      job['crop'], job['final_size_mod'], job['final_size'],
+      tile_height=job['tile_height'])
+
+@stage
+def encode_frame(frame):
+  # ...and finally save
+  frame['img'].save(frame['job']['out_path'])
+  frame['img'] = None
+
+def new_frame(job):
+  return {'job': job, 'img': None, 'trafo': None, 'error': None}
+
+def render_frame(job):
+  frame = encode_frame(warp_frame(decode_frame(new_frame(job))))
+  return (job['i'], frame['error'])
+
+class Stage(object):
+  # a group of threads applying `fct` to the items in `in_queue`, and passing
+  # the results on to `out_queue`; None marks the end of the stream
+  def __init__(self, name, fct, n_threads, in_queue, out_queue):
+    self.name = name
+    self.fct = fct
+    self.n_threads = n_threads
+    self.in_queue = in_queue
+    self.out_queue = out_queue
+
+    self.busy_time = 0.0
+    self.n_running = n_threads
+    self.lock = threading.Lock()
+    self.threads = [threading.Thread(target=self.run_)
+                    for _ in xrange(n_threads)]
+    for thread in self.threads:
+      thread.daemon = True
+
+  def start(self):
+    for thread in self.threads:
+      thread.start()
+
+  def run_(self):
     while True:
-      line = f.readline().strip()
-      if len(line) == 0:
+      item = self.in_queue.get()
+      if item is None:
+        # let the other threads in this stage see the end marker, too
+        self.in_queue.put(None)
         break
-      
-      if line[0] == '#':
-        if first_comment is None:
-          first_comment = line
-          pad_value = parse_key_tuple(first_comment, "pad")
-          dims_value = parse_key_tuple(first_comment, "dims")
-          
-          if pad_value is not None and len(pad_value) == 2:
-            pad_x, pad_y = pad_value
-          if dims_value is not None and len(dims_value) == 2:
-            width, height = dims_value
-          
-        continue
 
-      params_str = [_.strip() for _ in line.split('\t')]
-      if header is None:
-        header = params_str
-      else:
-        trafo = {param: float(params_str[i]) for i, param in enumerate(header)}
-        trafo['pad'] = (pad_x, pad_y)
-        trafo['dims'] = (width, height)
-        trafos.append(trafo)
+      t0 = time.time()
+      item = self.fct(item)
+      with self.lock:
+        self.busy_time += time.time() - t0
+      self.out_queue.put(item)
+
+    with self.lock:
+      self.n_running -= 1
+      if self.n_running == 0:
+        self.out_queue.put(None)
+
+  def occupancy(self, wall_time):
+    # fraction of time the threads in this stage spent working
+    return self.busy_time/(self.n_threads*wall_time) if wall_time > 0 else 0
+
+def run_pipeline(jobs, threads=(1, 1, 1)):
+  # decode, warp and encode frames in separate stages that overlap in time;
+  # the bounded queues between the stages keep the number of decoded images
+  # in memory small, and results are yielded in the order of `jobs`
+  assert len(threads) == 3 and min(threads) >= 1
+  queues = [Queue.Queue(maxsize=max(n, 1)) for n in threads]
+  queues.append(Queue.Queue())
+  stages = [Stage(name, fct, n, queues[k], queues[k+1])
+            for k, (name, fct, n) in enumerate(zip(
+                ['decode', 'warp', 'encode'],
+                [decode_frame, warp_frame, encode_frame], threads))]
+
+  def feed():
+    for job in jobs:
+      queues[0].put(new_frame(job))
+    queues[0].put(None)
+
+  t0 = time.time()
+  feeder = threading.Thread(target=feed)
+  feeder.daemon = True
+  feeder.start()
+  for s in stages:
+    s.start()
+
+  order = [job['i'] for job in jobs]
+  pending = {}
+  next_k = 0
+  while True:
+    frame = queues[-1].get()
+    if frame is None:
+      break
+    pending[frame['job']['i']] = frame['error']
+    while next_k < len(order) and order[next_k] in pending:
+      yield (order[next_k], pending.pop(order[next_k]))
+      next_k += 1
+
+  wall_time = time.time() - t0
+  feeder.join()
+  for s in stages:
+    for thread in s.threads:
+      thread.join()
+
+  print("Stage occupancy: " + ", ".join(
+      "{} {:.0f}% ({} thread{})".format(s.name, 100*s.occupancy(wall_time),
+                                        s.n_threads,
+                                        "s" if s.n_threads > 1 else "")
+      for s in stages))
+
+def get_frame_key(job):
+  # content key for everything that affects a rendered frame; the source is
+  # identified by its size and modification time
+  try:
+    stat = os.stat(job['fname'])
+  except OSError:
+    return None
+
+  # arrays are listed in full, as their repr rounds the values
+  trafo = [(key, value.tolist() if isinstance(value, np.ndarray) else value)
+           for key, value in sorted(job['trafo'].items())]
+  inputs = [(os.path.abspath(job['fname']), stat.st_size, stat.st_mtime),
+            trafo]
+  inputs.extend((key, job[key]) for key in sorted(job.keys())
+                if key not in ['i', 'fname', 'trafo', 'out_path',
+                               'tile_height'])
+  return hashlib.sha1(repr(inputs)).hexdigest()
+
+def read_manifest(fname):
+  # map from output file name to the key of the frame it was rendered from;
+  # later lines override earlier ones
+  manifest = {}
+  try:
+    with open(fname, 'rt') as f:
+      for line in f:
+        fields = line.strip().split('\t')
+        if len(fields) == 2:
+          manifest[fields[0]] = fields[1]
+  except IOError:
+    pass
 
-    return trafos
+  return manifest
 
-def transform(files, trafos, out_dir, anchors, crop=None, final_size=None):
-  i = 0
+def write_manifest(fname, manifest):
+  tmp_fname = fname + '.tmp'
+  with open(tmp_fname, 'wt') as f:
+    for out_name in sorted(manifest.keys()):
+      f.write("{}\t{}\n".format(out_name, manifest[out_name]))
+  os.rename(tmp_fname, fname)
+
+def transform(files, trafos, out_dir, anchors, crop=None, final_size=None,
+              render='affine', jobs=1, draft=True, preview=False, force=False,
+              threads=(1, 1, 1), tile_height=None, model=None):
+  # `trafos` is a list of parameter dicts, as from read_trafos, or, with a
+  # `model`, an (n_images, 3, 3) array of matrices
   n = min(len(files), len(trafos))
+  if n == 0:
+    return []
+
   crop_region = crop
+  if crop_region is None:
+    # only the headers are read here, up to the first file that opens; the
+    # ones that do not are reported when their frames fail to render
+    fraction = 1.0
+    size0 = None
+    for i in xrange(n):
+      try:
+        size0 = Image.open(files[i]).size
+        break
+      except (IOError, OSError):
+        continue
+    if size0 is None:
+      print("WARNING: none of the {} images could be opened.".format(n))
+      return range(n)
+    crop_region = (0, 0, size0[0]*fraction, size0[1]*fraction)
+
+  if preview:
+    # low resolution rendering, meant for checking the alignment quickly
+    if final_size is None:
+      final_size = (crop_region[2] - crop_region[0],
+                    crop_region[3] - crop_region[1])
+    final_size = tuple(max(int(round(PREVIEW_SCALE*_)), 1)
+                       for _ in final_size)
+    draft = True
+
+    # kept apart, so that a preview does not overwrite the full-resolution
+    # frames or their manifest
+    out_dir = os.path.join(out_dir, PREVIEW_DIR)
+    if not os.path.isdir(out_dir):
+      os.makedirs(out_dir)
+
   final_size_mod = None
-  for fname, trafo in zip(files, trafos):
-    base_name, ext = os.path.splitext(os.path.basename(fname))
+  if final_size is not None:
+    final_size_mod = get_final_size(crop_region, final_size)
+
+  frame_jobs = []
+  for i, fname in enumerate(files[:n]):
+    if model is not None:
+      trafo = {'matrix': trafos[i], 'model': model}
+    else:
+      trafo = trafos[i]
+    trafo = check_trafo(trafo)
+#    base_name, ext = os.path.splitext(os.path.basename(fname))
 #    out_fname = base_name + '_trans' + ext
 #    out_path = os.path.join(out_dir, out_fname)
-    out_path = os.path.join(out_dir, 'img{:05}.jpg'.format(i))
-
-    print("Image {} of {}.".format(i+1, n))
-
-    img0 = Image.open(fname)
-    if anchors is not None:
-      n_anchors = len(anchors[i])
-      for j in xrange(n_anchors):
-        anchor = np.asarray(anchors[i][j])
-        img0.putpixel(anchor, (255, 0, 0))
-        for k in xrange(-8, 8):
-          for l in xrange(-8, 8):
-            img0.putpixel(anchor + (k, l), (255, 0, 0))
-
-    if crop_region is None:
-      fraction = 1.0
-      final_width = img0.size[0]*fraction
-      final_height = img0.size[1]*fraction
-      crop_region = (0, 0, final_width, final_height)
-
-    if final_size_mod is None and final_size is not None:
-      final_width = float(crop_region[2] - crop_region[0])
-      final_height = float(crop_region[3] - crop_region[1])
-      ratio = min(final_size[0]/final_width, final_size[1]/final_height)
-      final_size_mod = (int(round(final_width*ratio)),
-                        int(round(final_height*ratio)))
-
-    if sorted(trafo.keys()) == sorted(['alpha','x', 'y', 'theta', 'pad',
-          'dims']):
-      raise Exception('Not supported')
-    elif sorted(trafo.keys()) == sorted(['a', 'b', 'dx', 'dy', 'pad', 'dims']):
-      alpha = math.sqrt(trafo['a']**2 + trafo['b']**2)
-      theta = math.atan2(trafo['b'], trafo['a'])
-      dx = trafo['dx']
-      dy = trafo['dy']
-
-      # first scale
-      img1 = img0.resize((int(round(alpha*_)) for _ in img0.size),
-                          Image.ANTIALIAS)
-      
-      # next rotate, expanding as necessary
-      img2 = img1.rotate(180.0*theta/math.pi, resample=Image.BICUBIC,
-                         expand=True)
-
-      # then we would need to shift by (dx, dy), plus some amount because we
-      # rotate around center instead of corner
-      # and crop around the center of the resulting image
-      # that means that we need to crop around img2.size/2 - (dx, dy)
-
-      # now crop
-      c = math.cos(theta)
-      s = math.sin(theta)
-      rot_x = -img2.size[0]/2.0 + img1.size[0]/2.0*c + img1.size[1]/2.0*s
-      rot_y = -img2.size[1]/2.0 + img1.size[1]/2.0*c - img1.size[0]/2.0*s
-      corner_x = -dx - rot_x
-      corner_y = -dy - rot_y
-      crop_region_crt = (int(round(corner_x + crop_region[0])),
-                         int(round(corner_y + crop_region[1])),
-                         int(round(corner_x + crop_region[2])),
-                         int(round(corner_y + crop_region[3])))
-      img3 = img2.crop(crop_region_crt)
-
-      if final_size_mod is not None:
-        img4 = img3.resize(final_size_mod, Image.ANTIALIAS)
-        img_final = Image.new(img4.mode, final_size)
-        img_final.paste(img4, tuple(
-            (img_final.size[_] - img4.size[_])/2 for _ in xrange(2)))
-      else:
-        img_final = img3
-      
-      # ...and finally save
-      img_final.save(out_path)
-    else:
-      raise Exception("Unrecognized transformation parameters.");
+    frame_jobs.append({
+      'i':              i,
+      'fname':          fname,
+      'trafo':          trafo,
+      'anchors':        None if anchors is None else
+                        [tuple(int(round(_)) for _ in anchor)
+                         for anchor in anchors[i] if np.isfinite(anchor).all()],
+      'out_path':       os.path.join(out_dir, 'img{:05}.jpg'.format(i)),
+      'crop':           crop_region,
+      'final_size_mod': final_size_mod,
+      'final_size':     final_size,
+      'render':         render,
+      'draft':          draft,
+      'tile_height':    tile_height
+    })
+
+  # only render frames whose inputs changed since they were last rendered;
+  # the manifest is appended to after every frame, so that an interrupted
+  # run resumes where it stopped
+  manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+  manifest = {} if force else read_manifest(manifest_path)
+  keys = [get_frame_key(job) for job in frame_jobs]
+  dirty_jobs = [job for job, key in zip(frame_jobs, keys)
+                if key is None or manifest.get(
+                    os.path.basename(job['out_path'])) != key or
+                   not os.path.exists(job['out_path'])]
+  if len(dirty_jobs) < n:
+    print("Skipping {} unchanged images.".format(n - len(dirty_jobs)))
+
+  # workers only ever hold the frames they are rendering, and results come
+  # back in order, so progress is reported in sequence; without a process
+  # pool, decoding, warping and encoding run in an overlapping pipeline
+  pool = None
+  if jobs > 1:
+    pool = Pool(jobs)
+    results = pool.imap(render_frame, dirty_jobs)
+  else:
+    results = run_pipeline(dirty_jobs, threads)
+
+  failed = []
+  try:
+    with open(manifest_path, 'at') as manifest_file:
+      for i, error in results:
+        if error is None:
+          print("Image {} of {}.".format(i+1, n))
+          if keys[i] is not None:
+            out_name = os.path.basename(frame_jobs[i]['out_path'])
+            manifest[out_name] = keys[i]
+            manifest_file.write("{}\t{}\n".format(out_name, keys[i]))
+            manifest_file.flush()
+        else:
+          print("Image {} of {} failed ({}): {}".format(i+1, n, files[i],
+                                                        error))
+          failed.append(i)
+  finally:
+    if pool is not None:
+      pool.terminate()
+
+  # compact the manifest
+  write_manifest(manifest_path, manifest)
+
+  if len(failed) > 0:
+    print("WARNING: {} of {} images failed to render.".format(len(failed), n))
 
-    i += 1
+  return failed
 
 if __name__ == "__main__":
   args = parse_command_line()
@@ -196,8 +659,13 @@ if __name__ == "__main__":
   files.sort()
   out_dir = (args.output if args.output is not None else
               os.path.dirname(files[0]))
-  trafos = read_trafos(args.params)
-  anchors = None if args.anchors is None else read_anchors(args.anchors)[1]
+  model = None
+  if is_trafo_matrix_file(args.params):
+    trafos, model = read_trafo_matrices(args.params)
+  else:
+    trafos = read_trafos(args.params)
+  anchors = (None if args.anchors is None else
+             read_anchor_array(args.anchors)[1])
 
   if len(files) < len(trafos):
     print("WARNING: There are more transformations than files.")
@@ -207,7 +675,13 @@ if __name__ == "__main__":
     print("WARNING: There are more files than transformations.")
     print("         Some files will be ignored.")
   
-  transform(files, trafos, out_dir=out_dir, anchors=anchors,
+  failed = transform(files, trafos, out_dir=out_dir, anchors=anchors,
             crop=None if args.crop is None else 
                   tuple(int(word) for word in args.crop.split(',')),
-            final_size=tuple(int(word) for word in args.final_size.split(',')))
+            final_size=tuple(int(word) for word in args.final_size.split(',')),
+            render=args.render, jobs=args.jobs, draft=args.draft,
+            preview=args.preview, force=args.force,
+            threads=args.threads,
+            tile_height=args.tile_height, model=model)
+  if len(failed) > 0:
+    sys.exit(1)